@@ -0,0 +1,53 @@
+# import time benchmark, each import is measured in a fresh interpreter
+
+import sys
+import json
+import argparse
+import subprocess
+
+modules = ["constants", "util", "sokoban", "file", "corpus", "solver",
+           "generator", "renderer", "table", "tensor", "detector", "macro",
+           "deadlock", "data", "solution", "pattern_db", "statespace",
+           "cache", "worker", "service"]
+
+# optional dependencies that should only be loaded on first use
+heavy_modules = ["scipy", "skimage", "tensor"]
+
+probe = """
+import sys, time, json
+t = time.perf_counter()
+import %s
+t = time.perf_counter() - t
+print(json.dumps({ "time" : t, "loaded" : [name for name in %r
+                                           if name in sys.modules] }))
+"""
+
+def time_import(module, repeats = 5):
+    """median import time of module in seconds, and the heavy modules that
+       were loaded as a side effect of importing it
+    """
+    times = []
+    loaded = []
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, "-c",
+                                 probe % (module, heavy_modules)],
+                                capture_output = True, check = True,
+                                text = True).stdout
+        result = json.loads(output)
+        times.append(result["time"])
+        loaded = result["loaded"]
+    return sorted(times)[len(times) // 2], loaded
+
+def benchmark_imports(modules = modules, repeats = 5):
+    print("%-12s %10s   %s" % ("module", "time (ms)", "loaded"))
+    for module in modules:
+        t, loaded = time_import(module, repeats)
+        print("%-12s %10.1f   %s" % (module, t * 1000,
+                                     ", ".join(loaded) or "-"))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "benchmark import times")
+    parser.add_argument("modules", nargs = "*", default = modules)
+    parser.add_argument("--repeats", type = int, default = 5)
+    args = parser.parse_args()
+    benchmark_imports(args.modules, args.repeats)
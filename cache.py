@@ -0,0 +1,277 @@
+# persistent solution cache, shared by many processes through sqlite
+
+import os
+import json
+import time
+import inspect
+import sqlite3
+import hashlib
+import numpy as np
+
+from random import *
+
+from constants import *
+from sokoban import *
+from solution import *
+from solver import *
+
+# bump whenever the layout of the table or the keys change
+SOLUTION_CACHE_VERSION = 3
+
+solution_cache_file = ".solution_cache.sqlite"
+
+# functions
+
+def isometry_map(shape, t):
+    """for isometry t of a board of shape, output: (forward, backward) where
+       forward[r, c] is the flat index of (r, c) in the transformed board,
+       and backward[r', c'] is the flat index of (r', c') in the original
+    """
+    backward = isometry(np.arange(shape[0] * shape[1]).reshape(shape), t)
+    forward = np.empty(shape[0] * shape[1], dtype = np.int64)
+    forward[backward.flatten()] = np.arange(backward.size)
+    return forward.reshape(shape), backward
+
+def map_pushes(pushes, mapping, cols):
+    """move (box row, box col, direction) pushes onto another board, where
+       mapping[r, c] is the flat index on that board, which has cols columns
+    """
+    mapped = []
+    for row, col, d in pushes:
+        # directions are mapped through the cell the player pushes from
+        player = (row - directions[d][0], col - directions[d][1])
+        box_ = divmod(int(mapping[row, col]), cols)
+        player_ = divmod(int(mapping[player]), cols)
+        d_ = direction_index[(box_[0] - player_[0], box_[1] - player_[1])]
+        mapped.append((box_[0], box_[1], d_))
+    return mapped
+
+def settings(obj):
+    """constructor arguments that obj keeps as attributes of the same name,
+       e.g. weights + heuristics, but not the state of its last search
+    """
+    names = list(inspect.signature(type(obj).__init__).parameters)[1 :]
+    return { name : describe(getattr(obj, name)) for name in names
+             if hasattr(obj, name) }
+
+def describe(obj):
+    """json-able description of a solver or heuristic + its settings"""
+    if isinstance(obj, np.generic):
+        obj = obj.item()
+    if isinstance(obj, (int, float, str, bool)) or obj is None:
+        return obj
+    if isinstance(obj, (list, tuple)):
+        return [describe(item) for item in obj]
+    if isinstance(obj, (Solver, Heuristic)):
+        description = dict(settings(obj), **{ "class" : type(obj).__name__ })
+        if isinstance(obj, Heuristic):
+            description["max"] = [describe(h) for h in obj._max_with]
+        return description
+    if isinstance(obj, dict):
+        return { str(key) : describe(value) for key, value in obj.items() }
+    # e.g. boards of deadlock tables, which are told apart by the config of
+    # a cached solver instead
+    return type(obj).__name__
+
+# classes
+
+class SolutionCache:
+    """sqlite table of solutions, keyed by canonical puzzle hash + solver
+       settings. pushes are stored in the canonical orientation of the
+       puzzle, so that rotated / reflected copies share an entry. entries
+       are evicted least recently used first, beyond max_bytes
+    """
+    def __init__(self, file_path = solution_cache_file, max_bytes = 10 ** 9,
+                 timeout = 60):
+        self.file_path = file_path
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.pid = None
+        self.db = None
+        self.hits = 0
+        self.misses = 0
+
+    def connect(self):
+        # connections can't be shared across processes, so each process
+        # (e.g. after a fork) opens its own
+        if self.db is not None and self.pid == os.getpid():
+            return self.db
+        self.pid = os.getpid()
+        self.db = sqlite3.connect(self.file_path, timeout = self.timeout,
+                                  isolation_level = None)
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute("PRAGMA synchronous = NORMAL")
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            # entries of other versions can't be used, so they are dropped
+            version = self.db.execute("PRAGMA user_version").fetchone()[0]
+            if version != SOLUTION_CACHE_VERSION:
+                self.db.execute("DROP TABLE IF EXISTS solutions")
+                self.db.execute("PRAGMA user_version = %d" %
+                                SOLUTION_CACHE_VERSION)
+            self.db.execute("""CREATE TABLE IF NOT EXISTS solutions (
+                                 key TEXT PRIMARY KEY,
+                                 solved INTEGER,
+                                 status TEXT,
+                                 pushes TEXT,
+                                 nodes INTEGER,
+                                 seconds REAL,
+                                 seed INTEGER,
+                                 size INTEGER,
+                                 last_used REAL)""")
+            self.db.execute("""CREATE INDEX IF NOT EXISTS solutions_last_used
+                               ON solutions (last_used)""")
+            self.db.execute("COMMIT")
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        return self.db
+
+    def get(self, key):
+        db = self.connect()
+        row = db.execute("""SELECT solved, status, pushes, nodes, seconds,
+                                   seed
+                            FROM solutions WHERE key = ?""",
+                         (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        db.execute("UPDATE solutions SET last_used = ? WHERE key = ?",
+                   (time.time(), key))
+        solved, status, pushes, nodes, seconds, seed = row
+        return { "solved" : bool(solved), "status" : status,
+                 "pushes" : json.loads(pushes) if solved else None,
+                 "nodes" : nodes, "seconds" : seconds, "seed" : seed }
+
+    def put(self, key, pushes, nodes, seconds, seed = None, status = None):
+        pushes_ = json.dumps(pushes, separators = (",", ":"))
+        size = len(key) + len(pushes_) + len(status or "") + 72
+        db = self.connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute("""INSERT OR REPLACE INTO solutions
+                          VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                       (key, pushes is not None, status, pushes_, nodes,
+                        seconds, seed, size, time.time()))
+            self.evict(db)
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def evict(self, db):
+        """delete least recently used entries until within max_bytes"""
+        if self.max_bytes is None:
+            return
+        total = db.execute("SELECT SUM(size) FROM solutions").fetchone()[0]
+        if total is None or total <= self.max_bytes:
+            return
+        # evict down to 90% of the limit, so that eviction isn't run on
+        # every insert once the cache is full
+        excess = total - int(0.9 * self.max_bytes)
+        freed = 0
+        keys = []
+        for key, size in db.execute("""SELECT key, size FROM solutions
+                                       ORDER BY last_used"""):
+            if freed >= excess:
+                break
+            keys.append((key,))
+            freed += size
+        db.executemany("DELETE FROM solutions WHERE key = ?", keys)
+
+    def info(self):
+        db = self.connect()
+        entries, size = db.execute(
+            "SELECT COUNT(*), SUM(size) FROM solutions").fetchone()
+        return { "hits" : self.hits, "misses" : self.misses,
+                 "entries" : entries, "bytes" : size or 0 }
+
+    def clear(self):
+        self.connect().execute("DELETE FROM solutions")
+
+class CachedSolver(Solver):
+    """wraps any solver, so that puzzles it has already solved w/ the same
+       settings are looked up instead of searched. returns the same list of
+       states + actions as the wrapped solver, and sets the same status.
+       w/ a random state, the random module is reseeded after each solve
+       (w/ a seed that is drawn from it), so that it ends up in the same
+       state whether the solution was searched for or looked up
+    """
+    def __init__(self, solver, cache = None, config = None):
+        self.solver = solver
+        self.cache = SolutionCache() if cache is None else cache
+        # extra settings that the key should depend on, e.g. table versions
+        self.config = config
+        self.hit = False
+
+    @property
+    def visited(self):
+        # nothing is visited when a solution is looked up, see self.nodes
+        return set() if self.hit else getattr(self.solver, "visited", set())
+
+    def key(self, form, kwargs):
+        settings = { "solver" : describe(self.solver),
+                     "config" : self.config,
+                     "kwargs" : describe(kwargs) }
+        digest = hashlib.sha1(form)
+        digest.update(json.dumps(settings, sort_keys = True).encode("utf-8"))
+        return digest.hexdigest()
+
+    def solve(self, sokoban, max_nodes = None, **kwargs):
+        """same arguments as the wrapped solver, where max_nodes = None
+           leaves the default of the wrapped solver
+        """
+        if max_nodes is not None:
+            kwargs["max_nodes"] = max_nodes
+        form, t = sokoban.canonical_form()
+        key = self.key(form, { name : kwargs[name] for name in kwargs
+                               if name != "quiet" })
+        shape = sokoban.board.shape
+        entry = self.cache.get(key)
+        if entry is not None:
+            self.hit = True
+            self.nodes, self.seconds = entry["nodes"], entry["seconds"]
+            self.status = entry["status"] or \
+                          ("solved" if entry["solved"] else None)
+            # leave the random module in the same state as a solve would
+            if entry["seed"] is not None:
+                seed(entry["seed"])
+            if not entry["solved"]:
+                return None
+            _, backward = isometry_map(shape, t)
+            pushes = map_pushes(entry["pushes"], backward, shape[1])
+            return self.replay(sokoban, pushes)
+
+        self.hit = False
+        start_time = time.time()
+        solution = self.solver.solve(sokoban, **kwargs)
+        self.seconds = time.time() - start_time
+        self.nodes = len(getattr(self.solver, "visited", ()))
+        self.status = getattr(self.solver, "status", None)
+
+        pushes = None
+        if solution is not None:
+            forward, backward = isometry_map(shape, t)
+            pushes = map_pushes([(box.row, box.col, d) for box, d
+                                 in solution_pushes(solution)],
+                                forward, backward.shape[1])
+        seed_ = None
+        if kwargs.get("state") is not None:
+            seed_ = getrandbits(63)
+            seed(seed_)
+        self.cache.put(key, pushes, self.nodes, self.seconds, seed_,
+                       self.status)
+        return solution
+
+    def replay(self, sokoban, pushes):
+        """rebuild the list of states + actions from (row, col, d) pushes"""
+        sokoban = sokoban.copy()
+        sokoban.player = sokoban.get_normalized_player_position()
+        history = [sokoban]
+        for row, col, d in pushes:
+            action = BoxPushAction(Position(row, col), directions[d])
+            sokoban = sokoban.copy()
+            action.act(sokoban)
+            history += [action, sokoban]
+        return history
@@ -30,3 +30,10 @@ microban_encoding = {
     PLAYER + GOAL   : '&',
     BOX + GOAL      : '*',
 }
+
+# characters used by other level collections
+alternative_decoding = {
+    '+'             : PLAYER + GOAL,
+    '-'             : SPACE,
+    '_'             : SPACE,
+}
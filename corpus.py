@@ -0,0 +1,171 @@
+# packed single-file puzzle corpus w/ random access
+
+import os
+import re
+import mmap
+import json
+import struct
+import numpy as np
+
+from constants import *
+from file import *
+from sokoban import *
+
+# file layout (little endian):
+#   header: magic, version, # puzzles, offset of index
+#   records: rows, cols, player row, player col (-1 if none), metadata len,
+#            bit-packed wall / box / goal planes, json metadata
+#   index: offset of each record, followed by offset of the index itself
+MAGIC = b"SKBC"
+VERSION = 1
+HEADER = struct.Struct("<4sHQQ")
+RECORD = struct.Struct("<HHhhI")
+
+# functions
+
+def pack_puzzle(sokoban, metadata = None):
+    board = sokoban.board
+    goals = np.zeros(board.shape, dtype = bool)
+    for goal in sokoban.goals:
+        goals[goal.row, goal.col] = True
+    planes = np.packbits(np.stack([board == WALL, board == BOX, goals]))
+    meta = b"" if not metadata else json.dumps(metadata).encode("utf-8")
+    player = (-1, -1) if sokoban.player is None else tuple(sokoban.player)
+    return RECORD.pack(board.rows, board.cols, player[0], player[1],
+                       len(meta)) + planes.tobytes() + meta
+
+def unpack_puzzle(buffer, offset):
+    rows, cols, player_row, player_col, meta_len = \
+        RECORD.unpack_from(buffer, offset)
+    offset += RECORD.size
+    n_bytes = (3 * rows * cols + 7) // 8
+    planes = np.unpackbits(np.frombuffer(buffer, dtype = np.uint8,
+                                         count = n_bytes, offset = offset),
+                           count = 3 * rows * cols).reshape(3, rows, cols)
+    board = Board.from_array(planes[0] * WALL + planes[1] * BOX)
+    goals = [Position(r, c) for r, c in zip(*planes[2].nonzero())]
+    player = None if player_row < 0 else Position(player_row, player_col)
+    return Sokoban(board, player, goals)
+
+# classes
+
+class CorpusWriter:
+    """append puzzles to a new corpus file. the index is written on close"""
+    def __init__(self, file_path):
+        self.file = open(file_path, mode = "wb")
+        self.file.write(HEADER.pack(MAGIC, VERSION, 0, 0))
+        self.offsets = []
+
+    def add(self, sokoban, **metadata):
+        self.offsets.append(self.file.tell())
+        self.file.write(pack_puzzle(sokoban, metadata))
+
+    def close(self):
+        if self.file.closed:
+            return
+        index_offset = self.file.tell()
+        self.file.write(np.array(self.offsets + [index_offset],
+                                 dtype = "<u8").tobytes())
+        self.file.seek(0)
+        self.file.write(HEADER.pack(MAGIC, VERSION, len(self.offsets),
+                                    index_offset))
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class Corpus:
+    """read-only, memory-mapped view of a corpus file. puzzles are decoded
+       lazily when indexed, and slicing returns another lazy view
+    """
+    def __init__(self, file_path, _parent = None, _indices = None):
+        if _parent is not None:
+            self.mmap, self.offsets = _parent.mmap, _parent.offsets
+            self.indices = _indices
+            return
+
+        with open(file_path, mode = "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        magic, version, count, index_offset = HEADER.unpack_from(self.mmap)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Not a puzzle corpus: " + str(file_path))
+        # copy the index, since close() fails while any array still points
+        # into the mmap
+        self.offsets = np.frombuffer(self.mmap, dtype = "<u8",
+                                     count = count + 1,
+                                     offset = index_offset).copy()
+        self.indices = range(count)
+
+    def metadata(self, index):
+        offset = int(self.offsets[self.indices[index]])
+        rows, cols, _, _, meta_len = RECORD.unpack_from(self.mmap, offset)
+        if meta_len == 0:
+            return {}
+        offset += RECORD.size + (3 * rows * cols + 7) // 8
+        return json.loads(bytes(self.mmap[offset : offset + meta_len]))
+
+    def close(self):
+        self.mmap.close()
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, index):
+        if type(index) is slice:
+            return Corpus(None, self, self.indices[index])
+        return unpack_puzzle(self.mmap, int(self.offsets[self.indices[index]]))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+# importers + exporters
+
+def import_directory(puzzle_dir, corpus_file):
+    """pack puzzle_dir/gen_<n>.txt files into a corpus, in order of n"""
+    names = [name for name in os.listdir(puzzle_dir)
+             if re.fullmatch(r"gen_\d+\.txt", name)]
+    names.sort(key = lambda name: int(name[4 : -4]))
+    with CorpusWriter(corpus_file) as writer:
+        for name in names:
+            writer.add(parse_puzzle(os.path.join(puzzle_dir, name)),
+                       name = name)
+    return len(names)
+
+def import_collection(collection_file, corpus_file):
+    """pack the levels of a multi-level .txt collection into a corpus"""
+    n = 0
+    with CorpusWriter(corpus_file) as writer:
+        for title, sokoban in parse_collection(collection_file):
+            writer.add(sokoban, **({} if title is None else
+                                   { "title" : title }))
+            n += 1
+    return n
+
+def export_directory(corpus_file, puzzle_dir):
+    """write each puzzle of a corpus to puzzle_dir/gen_<n>.txt, from n = 1"""
+    os.makedirs(puzzle_dir, exist_ok = True)
+    with Corpus(corpus_file) as corpus:
+        for i, sokoban in enumerate(corpus):
+            with open(os.path.join(puzzle_dir, "gen_%d.txt" % (i + 1)),
+                      mode = "w", encoding = "utf-8") as f:
+                f.write(str(sokoban))
+        return len(corpus)
+
+def export_collection(corpus_file, collection_file):
+    """write all puzzles of a corpus to a single multi-level .txt file"""
+    with Corpus(corpus_file) as corpus, \
+         open(collection_file, mode = "w", encoding = "utf-8") as f:
+        for i, sokoban in enumerate(corpus):
+            title = corpus.metadata(i).get("title", str(i + 1))
+            f.write("; " + title + "\n\n" + str(sokoban).rstrip() + "\n\n")
+        return len(corpus)
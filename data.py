@@ -1,15 +1,22 @@
 # functions for generating data
 
 import os
+import json
 import array
+import multiprocessing
 from math import *
-from random import choice
+from random import *
 
+from cache import *
 from constants import *
+from corpus import *
 from deadlock import *
 from file import *
 from solver import *
 from sokoban import *
+from statespace import *
+from table import *
+from tensor import *
 from util import *
 
 puzzles_dir = "puzzles/i2a_generated"
@@ -28,45 +35,61 @@ def gen_deadlock_table_from_basis(max_area = (4, 5),
        os.path.getsize(deadlock_table_file) > 0:
         print("Warning: appending to a table file with existing content")
     
-    deadlock_basis = parse_deadlock_table(deadlock_basis_file)
-    deadlock_patterns = gen_deadlock_table_from_basis_same_size(deadlock_basis)
+    deadlock_patterns = load_deadlock_table(deadlock_basis_file)
 
     print(str(len(deadlock_patterns)) + " areas in dict")
     for area in deadlock_patterns:
         print(str(len(deadlock_patterns[area])) + " elements in " + str(area))
     
+    # configs are enumerated + matched against the patterns a block at a time
     total_configs = 3 ** (max_area[0] * max_area[1])
+    codes = { area : table_codes(deadlock_patterns, area)
+              for area in deadlock_patterns }
     with open(deadlock_table_file, mode = "ab") as f:
-        for i, board in enumerate(
-            generate_board_configs(area = max_area, objs = [SPACE, WALL, BOX])):
-            if i % int(total_configs // 10000) == 0:
-                quiet or print(str(i / (total_configs // 100)) + "%")
-            if len(list(board.boxes)) > max_boxes:
+        for configs, boards in generate_board_config_blocks(
+                max_area, [SPACE, WALL, BOX], block_size = 2 ** 16,
+                max_boxes = None if max_boxes == inf else max_boxes):
+            if len(configs) == 0:
                 continue
+            quiet or print(str(100 * configs[-1] / total_configs) + "%")
+            detected = deadlock_detected_many(deadlock_patterns, boards,
+                                              codes = codes)
 
-            if deadlock_detected(board):
-                # formats larger than (4, 5) are not supported currently
-                f.write(array.array('L', [board.encode()]))
+            # formats larger than (4, 5) are not supported currently
+            f.write(array.array('L', encode_boards(boards[detected]).tolist()))
             
 def gen_deadlock_data(deadlock_table_file = deadlock_table_file,
-                      deadlock_data_dir = deadlock_data_dir):
+                      deadlock_data_dir = deadlock_data_dir, exact = False):
+    """w/ exact, solutions + labels are looked up in the state space of
+       each puzzle instead of searched for w/ A* + the deadlock table
+    """
     deadlock_table = parse_deadlock_table(deadlock_table_file)
     area = next(iter(deadlock_table)).shape
     deadlock_heuristic = DynamicDeadlockHeuristic({ area : deadlock_table })
     heuristic = ManhattanDistHeuristic().max(deadlock_heuristic)
     astar = AStarSolver(heuristic = heuristic)
+    exact_solver = StateSpaceSolver() if exact else None
     bfs = BFSSolver()
     for i in range(2001, 3001): #(1, n_puzzles + 1):
         print("puzzle #" + str(i))
         sokoban_file = puzzles_dir + "/gen_" + str(i) + ".txt"
         sokoban = parse_puzzle(sokoban_file)
+        solver, deadlock_heuristic_ = astar, deadlock_heuristic
+        if exact_solver is not None:
+            # exact solutions + labels, unless the state space is too large
+            try:
+                exact_solver.heuristic.space(sokoban)
+                solver = exact_solver
+                deadlock_heuristic_ = exact_solver.heuristic
+            except ValueError:
+                pass
         positive_cases = []
         negative_cases = []
         optimal_distances = []
         for j in range(5):
             print(" A star seed: " + str(j))
             # pick random puzzle state from solution path of A*
-            solution = astar.solve(sokoban, state = j)
+            solution = solver.solve(sokoban, state = j)
             solution_states = solution[::2]
             shuffle(solution_states)
             for sokoban_ in solution_states:
@@ -90,7 +113,7 @@ def gen_deadlock_data(deadlock_table_file = deadlock_table_file,
             shuffle(visited)
             for sokoban_ in visited:
                 if sokoban_ not in positive_cases and \
-                   deadlock_heuristic.evaluate(sokoban_) == inf:
+                   deadlock_heuristic_.evaluate(sokoban_) == inf:
                     positive_cases.append(sokoban_)
                     positive_data_file = deadlock_data_dir + \
                                          "/positive/puzzle_%d_%d.txt" % (i, j)
@@ -108,3 +131,163 @@ def gen_deadlock_data(deadlock_table_file = deadlock_table_file,
 # TODO - regenerate positive data w/ BFS solver
 # update deadlock table w/ (3, 4) basis
 # regenerate negative data using deadlock heuristic w/ new deadlock table
+
+# parallel, resumable dataset pipeline
+
+worker_state = {}
+
+def init_dataset_worker(corpus_file, deadlock_basis_file,
+                        solution_cache_file = None, exact = False):
+    # every worker process opens the corpus + loads the compiled table once
+    worker_state["corpus"] = Corpus(corpus_file)
+    worker_state["exact"] = exact
+    worker_state["deadlock_table"] = load_deadlock_table(deadlock_basis_file)
+    # A* solutions depend on the deadlock table, so its key is part of
+    # the key of every cached solution
+    worker_state["solution_cache"] = None if solution_cache_file is None \
+        else (SolutionCache(solution_cache_file),
+              artifact_key(deadlock_basis_file))
+
+def gen_puzzle_samples(task):
+    """positive (deadlocked) + negative samples for one puzzle, picked the
+       same way as gen_deadlock_data
+       output: list of (grid, puzzle #, seed, label, distance) tuples
+    """
+    i, n_seeds = task
+    sokoban = worker_state["corpus"][i - 1]
+    deadlock_heuristic = \
+        DynamicDeadlockHeuristic(worker_state["deadlock_table"])
+    heuristic = ManhattanDistHeuristic().max(deadlock_heuristic)
+    astar = AStarSolver(heuristic = heuristic)
+    if worker_state.get("solution_cache") is not None:
+        cache, config = worker_state["solution_cache"]
+        astar = CachedSolver(astar, cache, config)
+    if worker_state.get("exact"):
+        # exact solutions + labels, unless the state space is too large
+        try:
+            solver = StateSpaceSolver()
+            solver.heuristic.space(sokoban)
+            astar, deadlock_heuristic = solver, solver.heuristic
+        except ValueError:
+            pass
+    bfs = BFSSolver()
+
+    samples = []
+    positive_cases = []
+    negative_cases = []
+    for j in range(n_seeds):
+        # pick random puzzle state from solution path of A*
+        solution = astar.solve(sokoban, state = j)
+        solution_states = [] if solution is None else solution[::2]
+        shuffle(solution_states)
+        for sokoban_ in solution_states:
+            if sokoban_ not in negative_cases:
+                negative_cases.append(sokoban_)
+                dist = (len(solution) - solution.index(sokoban_) - 1) // 2
+                samples.append((encode_grid(sokoban_), i, j, 0, dist))
+                break
+
+        # pick random puzzle state with deadlock from visited set of BFS
+        bfs.solve(sokoban, max_nodes = 10 ** 3, state = j)
+        visited = list(bfs.visited)
+        shuffle(visited)
+        for sokoban_ in visited:
+            if sokoban_ not in positive_cases and \
+               deadlock_heuristic.evaluate(sokoban_) == inf:
+                positive_cases.append(sokoban_)
+                samples.append((encode_grid(sokoban_), i, j, 1, -1))
+                break
+    return samples
+
+def write_shard(file_path, samples):
+    """save samples as compressed arrays, w/ grids zero-padded to the same
+       shape. written to a temporary file first, so shards are never partial
+    """
+    rows = max([grid.shape[0] for grid, *_ in samples] + [0])
+    cols = max([grid.shape[1] for grid, *_ in samples] + [0])
+    grids = np.zeros((len(samples), rows, cols), dtype = np.uint8)
+    for k, (grid, *_) in enumerate(samples):
+        grids[k, : grid.shape[0], : grid.shape[1]] = grid
+    columns = list(zip(*samples)) if len(samples) > 0 else [[]] * 5
+    with open(file_path + ".tmp", mode = "wb") as f:
+        np.savez_compressed(
+            f, grids = grids,
+            shapes = np.array([grid.shape for grid in columns[0]],
+                              dtype = np.int32).reshape(-1, 2),
+            puzzles = np.array(columns[1], dtype = np.int32),
+            seeds = np.array(columns[2], dtype = np.int32),
+            labels = np.array(columns[3], dtype = np.uint8),
+            distances = np.array(columns[4], dtype = np.int32))
+    os.replace(file_path + ".tmp", file_path)
+
+def gen_deadlock_dataset(corpus_file, i_min, i_max,
+                         dataset_dir = deadlock_data_dir,
+                         deadlock_basis_file = deadlock_basis_file,
+                         shard_size = 100, n_seeds = 5, processes = None,
+                         solution_cache_file = None, exact = False,
+                         quiet = True):
+    """generate samples for puzzles #i_min ... #i_max of a corpus in
+       parallel, saved as shards of (shard_size) puzzles each. shards that
+       are listed in the manifest are skipped, so runs can be resumed.
+       w/ solution_cache_file, A* solutions are shared across runs. w/
+       exact, puzzles that are small enough are labeled w/ exact distances
+       from their state space instead
+    """
+    os.makedirs(dataset_dir, exist_ok = True)
+    manifest_file = os.path.join(dataset_dir, "manifest.json")
+    manifest = { "corpus" : corpus_file, "shard_size" : shard_size,
+                 "n_seeds" : n_seeds, "exact" : exact, "shards" : {} }
+    if os.path.exists(manifest_file):
+        with open(manifest_file, mode = "r", encoding = "utf-8") as f:
+            manifest = json.load(f)
+        if manifest["shard_size"] != shard_size or \
+           manifest["n_seeds"] != n_seeds or \
+           manifest.get("exact", False) != exact:
+            raise ValueError("Dataset settings differ from manifest")
+
+    # shards are aligned to multiples of shard_size, so resumed runs
+    # w/ different ranges still produce the same shards
+    shards = []
+    for start in range(i_min - (i_min - 1) % shard_size, i_max + 1,
+                       shard_size):
+        puzzles = range(max(start, i_min), min(start + shard_size, i_max + 1))
+        name = "shard_%06d.npz" % start
+
+        # redo shards that only cover part of the requested range, over
+        # both ranges. a shard records one range of puzzles, so ranges w/
+        # a gap between them can't be merged
+        done = manifest["shards"].get(name)
+        if done is not None:
+            if done["puzzles"][0] <= puzzles.start and \
+               puzzles.stop - 1 <= done["puzzles"][1]:
+                continue
+            if puzzles.start > done["puzzles"][1] + 1 or \
+               puzzles.stop < done["puzzles"][0]:
+                raise ValueError("Puzzles %d - %d of %s are not next to "
+                                 "puzzles %d - %d already in it" %
+                                 (puzzles.start, puzzles.stop - 1, name,
+                                  done["puzzles"][0], done["puzzles"][1]))
+            puzzles = range(min(puzzles.start, done["puzzles"][0]),
+                            max(puzzles.stop, done["puzzles"][1] + 1))
+        shards.append((name, puzzles))
+    tasks = [(i, n_seeds) for _, puzzles in shards for i in puzzles]
+
+    # compile the table before starting workers, so it is only built once
+    build_deadlock_table(deadlock_basis_file)
+    with multiprocessing.Pool(processes, init_dataset_worker,
+                              (corpus_file, deadlock_basis_file,
+                               solution_cache_file, exact)) as pool:
+        results = pool.imap(gen_puzzle_samples, tasks)
+        for name, puzzles in shards:
+            samples = [sample for _ in puzzles for sample in next(results)]
+            write_shard(os.path.join(dataset_dir, name), samples)
+
+            manifest["shards"][name] = { "puzzles" : [puzzles.start,
+                                                      puzzles.stop - 1],
+                                         "samples" : len(samples) }
+            with open(manifest_file + ".tmp", mode = "w",
+                      encoding = "utf-8") as f:
+                json.dump(manifest, f, indent = 1, sort_keys = True)
+            os.replace(manifest_file + ".tmp", manifest_file)
+            quiet or print("wrote " + name, flush = True)
+    return manifest
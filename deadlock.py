@@ -1,12 +1,16 @@
 # deadlock basis and table generation
 
+import os
 import time
+from functools import lru_cache
 from itertools import product
 
 from constants import *
 from file import *
 from sokoban import *
 from solver import *
+from table import *
+from util import *
 
 def build_area_containment_mapping(max_area = (4, 5)):
     """"area of size i x j, i <= j, where i is #rows and j is #cols
@@ -45,28 +49,61 @@ def next_area_in_topo_order(contains, area_list):
             if area not in area_list
             and all([sub_area in area_list for sub_area in contains[area]])][0]
 
+@lru_cache(maxsize = 8)
+def config_digit_table(n, objs):
+    """objects of each cell of configs #0 ... #(len(objs) ** n - 1) of n
+       cells, w/ the first cell as the most significant digit
+    """
+    codes = np.arange(len(objs) ** n, dtype = np.int64)
+    table = np.empty((len(codes), n), dtype = np.uint8)
+    for cell in range(n - 1, -1, -1):
+        codes, digits = np.divmod(codes, len(objs))
+        table[:, cell] = np.array(objs, dtype = np.uint8)[digits]
+    return table
+
+def decode_board_configs(start, stop, area, objs = [SPACE, WALL]):
+    """decode configs #start ... #(stop - 1) of generate_board_configs at
+       once, where each config is a number in base len(objs) w/ one digit
+       per cell, and the first cell is the most significant digit
+       output: (stop - start, rows, cols) uint8 array
+    """
+    # cells are split into two halves, each decoded by a table lookup
+    n = area[0] * area[1]
+    n_low = (n + 1) // 2
+    high, low = np.divmod(np.arange(start, stop, dtype = np.int64),
+                          len(objs) ** n_low)
+    boards = np.concatenate(
+        [config_digit_table(n - n_low, tuple(objs))[high],
+         config_digit_table(n_low, tuple(objs))[low]], axis = 1)
+    return boards.reshape((-1,) + tuple(area))
+
+def generate_board_config_blocks(area, objs = [SPACE, WALL],
+                                 block_size = 2 ** 16, max_boxes = None,
+                                 walls = None, start = 0, stop = None):
+    """enumerate the same configs as generate_board_configs, as blocks
+       input: max_boxes: skip configs w/ more boxes than this
+              walls: (rows, cols) boolean array of cells that must be walls
+              start, stop: range of config numbers to enumerate
+       output: yields (config numbers, (N, rows, cols) uint8 array) pairs,
+               w/ filtered configs left out of both
+    """
+    total = len(objs) ** (area[0] * area[1])
+    stop = total if stop is None else min(stop, total)
+    for start_ in range(start, stop, block_size):
+        stop_ = min(start_ + block_size, stop)
+        boards = decode_board_configs(start_, stop_, area, objs)
+        keep = np.ones(len(boards), dtype = bool)
+        if max_boxes is not None:
+            keep &= (boards == BOX).sum(axis = (1, 2)) <= max_boxes
+        if walls is not None:
+            keep &= (boards[:, walls] == WALL).all(axis = 1)
+        yield np.arange(start_, stop_, dtype = np.int64)[keep], boards[keep]
+
 def generate_board_configs(area, objs = [SPACE, WALL]):
     # TODO: enumerate boards w/ 0 walls, then 1 walls, ...
-    def generate_board_configs_(row, col):
-        if row < 0 or col < 0:
-            yield np.zeros(area, dtype = np.uint8)
-            return
-
-        if col == 0:
-            col_ = area[1] - 1
-            row_ = row - 1
-        else:
-            col_ = col - 1
-            row_ = row
-        
-        for board_array in generate_board_configs_(row_, col_):
-            for obj in objs:
-                board_array_ = board_array.copy()
-                board_array_[row, col] = obj
-                yield board_array_
-
-    for board_array in generate_board_configs_(area[0] - 1, area[1] - 1):
-        yield Board.from_array(board_array)
+    for _, boards in generate_board_config_blocks(area, objs):
+        for board_array in boards:
+            yield Board.from_array(board_array)
 
 @record_time
 def gen_deadlock_table_from_basis_same_size(deadlock_basis):
@@ -102,6 +139,92 @@ def subboard_matches(patterns, board):
                         return True
     return False
 
+@record_time
+def board_in_dynamic_deadlock(board, deadlock_table = {},
+                              max_nodes = (10 ** 4, 10 ** 5),
+                              exhaustive = False):
+    """determine if board is in dynamic deadlock,
+       i.e. if it is impossible to push all boxes off of the board
+       input: max_nodes: limits of the greedy + A* searches
+              exhaustive: if true, boards are only deadlocked if A* has
+                          tried every push, not if it ran out of nodes
+    """
+    # embed board in larger board w/ 1-space padding
+    board = Board.from_array(np.pad(board, 1, 'constant',
+                                    constant_values = SPACE))
+    sokoban = Sokoban(board, player = Position(0, 0), goals = [])
+
+    # check if it is possible to push all boxes off the board
+    gbfs_solver = GreedyBestFSSolver(RemainingBoxesHeuristic())
+    solution = gbfs_solver.solve(sokoban, max_nodes = max_nodes[0])
+    if solution is not None:
+        return False
+    heuristic = DynamicDeadlockHeuristic(deadlock_table) \
+                .max(RemainingBoxesHeuristic())
+    astar_solver = AStarSolver(heuristic)
+    solution = astar_solver.solve(sokoban, max_nodes = max_nodes[1])
+    if exhaustive:
+        return solution is None and astar_solver.status == "exhausted"
+    return solution is None
+
+def minimize_deadlock_pattern(board, deadlock_table = {},
+                              max_nodes = (10 ** 3, 10 ** 4)):
+    """turn boxes + walls of a deadlocked board into spaces (which match
+       anything in a basis) for as long as it stays deadlocked, then crop
+       rows + cols of only spaces from the edges
+       output: Board w/ no more rows than cols, as in a basis
+    """
+    board = np.array(board, dtype = np.uint8)
+    cells = list(zip(*(board == BOX).nonzero())) + \
+            list(zip(*(board == WALL).nonzero()))
+    for cell in cells:
+        board_ = board.copy()
+        board_[cell] = SPACE
+        if (board_ == BOX).any() and \
+           board_in_dynamic_deadlock(board_, deadlock_table, max_nodes,
+                                     exhaustive = True):
+            board = board_
+
+    rows = (board != SPACE).any(axis = 1).nonzero()[0]
+    cols = (board != SPACE).any(axis = 0).nonzero()[0]
+    board = board[rows[0] : rows[-1] + 1, cols[0] : cols[-1] + 1]
+    if board.shape[0] > board.shape[1]:
+        board = np.rot90(board)
+    return Board.from_array(board)
+
+def merge_deadlock_basis(basis_file, patterns):
+    """append patterns that aren't in a basis file yet (up to rotation +
+       reflection). tables compiled from the file are rebuilt when next
+       loaded, since they are keyed by its contents
+       output: list of patterns that were added
+    """
+    basis = parse_deadlock_table(basis_file) \
+            if os.path.exists(basis_file) else set()
+    known = set([(board_.shape, board_.tobytes()) for board in basis
+                 for board_ in board.isometric_boards])
+    added = []
+    for board in patterns:
+        if (board.shape, board.tobytes()) in known:
+            continue
+        known |= set([(board_.shape, board_.tobytes())
+                      for board_ in board.isometric_boards])
+        added.append(board)
+    if len(added) == 0:
+        return added
+
+    text = ""
+    if os.path.exists(basis_file):
+        with open(basis_file, mode = "r", encoding = "utf-8") as f:
+            text = f.read()
+    # added patterns go in their own group, after a blank line
+    if text != "":
+        text += "\n" if text.endswith("\n") else "\n\n"
+    text += "".join([str(board) + "\n" for board in added])
+    with open(basis_file + ".tmp", mode = "w", encoding = "utf-8") as f:
+        f.write(text)
+    os.replace(basis_file + ".tmp", basis_file)
+    return added
+
 def generate_dynamic_deadlock_basis(max_area = (4, 5), max_box = 4,
                                     current_basis = None, quiet = True):
     """generate a minimal set of deadlock patterns"""
@@ -120,26 +243,6 @@ def generate_dynamic_deadlock_basis(max_area = (4, 5), max_box = 4,
             table = gen_deadlock_table_from_basis_same_size([board])[area]
             deadlock_table[area] = deadlock_table.get(area, set()).union(table)
 
-    @record_time
-    def board_in_dynamic_deadlock(board):
-        """determine if board is in dynamic deadlock,
-           i.e. if it is possible to push all boxes off of the board
-        """
-        # embed board in larger board w/ 1-space padding
-        board = Board.from_array(np.pad(board, 1, 'constant',
-                                        constant_values = SPACE))
-        sokoban = Sokoban(board, player = Position(0, 0), goals = [])
-
-        # check if it is possible to push all boxes off the board
-        gbfs_solver = GreedyBestFSSolver(RemainingBoxesHeuristic())
-        solution = gbfs_solver.solve(sokoban, max_nodes = 10 ** 4)
-        if solution is None:
-            heuristic = DynamicDeadlockHeuristic(deadlock_table) \
-                        .max(RemainingBoxesHeuristic())
-            astar_solver = AStarSolver(heuristic)
-            solution = astar_solver.solve(sokoban, max_nodes = 10 ** 5)
-            return solution is None
-
     @record_time
     def add_box_and_test_deadlock(area, board, box_index = 0, n_box = max_box):
         """recursively add boxes and determine if board is in deadlock state"""
@@ -151,7 +254,7 @@ def generate_dynamic_deadlock_basis(max_area = (4, 5), max_box = 4,
             if deadlock_detected(deadlock_table, Sokoban(board_), None):
                 continue
 
-            if board_in_dynamic_deadlock(board_):
+            if board_in_dynamic_deadlock(board_, deadlock_table):
                 for possibly_redundant_board in deadlock_basis[area].copy():
                     if subboard_matches([board_], possibly_redundant_board):
                         deadlock_basis[area].remove(possibly_redundant_board)
@@ -253,3 +356,103 @@ def generate_static_deadlock_basis(max_area = (4, 5), max_box = 4,
             add_box_and_test_deadlock(area, board)
 
     return deadlock_basis
+
+class LearningDeadlockHeuristic(DynamicDeadlockHeuristic):
+    """dynamic deadlock lookups that also learn new patterns during search.
+       if no pattern matches around a pushed box, the cluster of boxes it
+       touches is cut out of the board (w/ a 1-cell margin), and searched
+       as if everything outside of the cut were open space. clusters that
+       provably can't be cleared are minimized, and added to the table in
+       place, so that other heuristics + later puzzles using the same
+       table prune them as well
+    """
+    def __init__(self, deadlock_table = None, max_area = (4, 5),
+                 min_boxes = 2, max_nodes = (10 ** 3, 10 ** 4),
+                 max_checked = 10 ** 5, verify = False):
+        super(LearningDeadlockHeuristic, self).__init__(
+            {} if deadlock_table is None else deadlock_table, verify)
+        self.max_area = tuple(sorted(max_area))
+        self.min_boxes = min_boxes
+        self.max_nodes = max_nodes
+
+        # clusters that have already been searched, and patterns learned
+        self.checked = LRUCache(max_entries = max_checked)
+        self.learned = []
+        self._learned_keys = set()
+
+    def cluster_window(self, sokoban, position):
+        """subboard around the boxes 8-connected to the box at position,
+           or None if it is too large, has too few boxes, or has a goal
+        """
+        board = sokoban.board
+        cluster = set([tuple(position)])
+        frontier = [tuple(position)]
+        while len(frontier) > 0:
+            r, c = frontier.pop()
+            for dr in (-1, 0, 1):
+                for dc in (-1, 0, 1):
+                    cell = (r + dr, c + dc)
+                    if cell not in cluster and board.in_bounds(cell) and \
+                       board[cell] == BOX:
+                        cluster.add(cell)
+                        frontier.append(cell)
+        if len(cluster) < self.min_boxes:
+            return None
+
+        rows, cols = zip(*cluster)
+        r_min = max(min(rows) - 1, 0)
+        r_max = min(max(rows) + 1, board.rows - 1)
+        c_min = max(min(cols) - 1, 0)
+        c_max = min(max(cols) + 1, board.cols - 1)
+        area = tuple(sorted([r_max - r_min + 1, c_max - c_min + 1]))
+        if area[0] > self.max_area[0] or area[1] > self.max_area[1]:
+            return None
+        # patterns only apply to subboards w/o goals
+        if any([goal.in_bounds(r_min, r_max + 1, c_min, c_max + 1)
+                for goal in sokoban.goals]):
+            return None
+        window = np.array(board[r_min : r_max + 1, c_min : c_max + 1])
+
+        # the search starts from outside of the cut, so it must be able to
+        # reach every space of the cluster, as the player may be in there
+        spaces = np.pad(window == SPACE, 1, 'constant', constant_values = 1)
+        labels = measure.label(spaces, background = 0, connectivity = 1)
+        if (labels[spaces] != labels[0, 0]).any():
+            return None
+        return window
+
+    def learn(self, window):
+        """search a cluster, and learn a pattern if it is deadlocked
+           output: true if the cluster is deadlocked
+        """
+        key = (window.shape, window.tobytes())
+        deadlocked = self.checked.get(key)
+        if deadlocked is None:
+            deadlocked = board_in_dynamic_deadlock(
+                window, self.deadlock_table, self.max_nodes,
+                exhaustive = True)
+            if deadlocked:
+                pattern = minimize_deadlock_pattern(
+                    window, self.deadlock_table, self.max_nodes)
+                key_ = (pattern.shape, pattern.tobytes())
+                # minimized patterns may already be covered by the table,
+                # e.g. when the window was cut at the edge of the board
+                if key_ not in self._learned_keys and \
+                   not deadlock_detected(self.deadlock_table,
+                                         Sokoban(pattern), None):
+                    add_deadlock_patterns(self.deadlock_table, [pattern])
+                    self.learned.append(pattern)
+                    self._learned_keys.add(key_)
+            self.checked.put(key, deadlocked)
+        return deadlocked
+
+    def _evaluate_child(self, sokoban, parent, action):
+        value = super(LearningDeadlockHeuristic, self) \
+                ._evaluate_child(sokoban, parent, action)
+        destination = action.destination
+        if value == inf or not sokoban.board.in_bounds(destination):
+            return value
+        window = self.cluster_window(sokoban, destination)
+        if window is not None and self.learn(window):
+            return inf
+        return value
@@ -0,0 +1,291 @@
+# runtime deadlock detection (freeze, goal matching, and corral deadlocks)
+
+from math import *
+
+from constants import *
+from sokoban import *
+from solver import *
+from util import *
+
+# classes
+
+class Level:
+    """static analysis of the walls + goals of a puzzle, shared by every
+       state of that puzzle. cells are indexed by row * cols + col
+    """
+    def __init__(self, sokoban):
+        board = sokoban.board
+        self.rows, self.cols = board.rows, board.cols
+        self.walls = [bool(x) for x in (board == WALL).flatten()]
+        self.goals = set([self.index(goal) for goal in sokoban.goals])
+
+        # neighbors[i][d] is the cell one step from i in direction d,
+        # or None if that step leaves the board (treated like a wall)
+        self.neighbors = [[self.step(i, d) for d in directions]
+                          for i in range(self.rows * self.cols)]
+
+        # cells from which a lone box can be pushed onto each goal
+        self.goal_reach = { goal : self.pullable_cells(goal)
+                            for goal in self.goals }
+        self.live = set().union(*self.goal_reach.values())
+
+    def index(self, position):
+        return position[0] * self.cols + position[1]
+
+    def step(self, i, d):
+        row, col = divmod(i, self.cols)
+        row, col = row + directions[d][0], col + directions[d][1]
+        if 0 <= row < self.rows and 0 <= col < self.cols:
+            return row * self.cols + col
+        return None
+
+    def free(self, i, boxes = ()):
+        return i is not None and not self.walls[i] and i not in boxes
+
+    def pullable_cells(self, goal):
+        """all cells from which a box can reach goal if no other boxes
+           are on the board, found by pulling the box away from the goal
+        """
+        cells = set([goal])
+        frontier = [goal]
+        while len(frontier) > 0:
+            box = frontier.pop()
+            for d in directions:
+                box_ = self.neighbors[box][d]
+                if self.free(box_) and box_ not in cells and \
+                   self.free(self.neighbors[box_][d]):
+                    cells.add(box_)
+                    frontier.append(box_)
+        return cells
+
+    def reachable(self, player, boxes):
+        """flood fill of cells reachable by the player"""
+        cells = set([player])
+        frontier = [player]
+        while len(frontier) > 0:
+            i = frontier.pop()
+            for j in self.neighbors[i]:
+                if self.free(j, boxes) and j not in cells:
+                    cells.add(j)
+                    frontier.append(j)
+        return cells
+
+# static analysis of recently seen puzzles, shared by all heuristics
+levels = LRUCache(max_entries = 16)
+
+# functions
+
+def get_level(sokoban):
+    """look up the static analysis for the walls + goals of sokoban"""
+    key = (sokoban.board.shape, (sokoban.board == WALL).tobytes(),
+           tuple((goal.row, goal.col) for goal in sokoban.goals))
+    level = levels.get(key)
+    if level is None:
+        level = Level(sokoban)
+        levels.put(key, level)
+    return level
+
+def get_boxes(level, sokoban):
+    return set([level.index(box) for box in sokoban.board.boxes])
+
+def box_frozen(level, boxes, box, checked = None):
+    """a box is frozen if it is blocked along both axes, where it is blocked
+       along an axis by a wall, by dead squares on both sides, or by another
+       frozen box. boxes that are already being checked count as walls
+    """
+    checked = set() if checked is None else checked
+    checked.add(box)
+    for axis in [(UP, DOWN), (LEFT, RIGHT)]:
+        sides = [level.neighbors[box][d] for d in axis]
+        if any([side is None or level.walls[side] for side in sides]):
+            continue
+        if all([side not in level.live for side in sides]):
+            continue
+        if any([side in boxes and (side in checked or
+                                   box_frozen(level, boxes, side, checked))
+                for side in sides]):
+            continue
+        return False
+    return True
+
+def goal_box_neighbors(level, boxes, box):
+    """boxes off of goals next to box, or next to boxes on goals that are
+       connected to box, i.e. the boxes that box may have frozen in place
+    """
+    cluster = set([box])
+    frontier = [box]
+    neighbors = set()
+    while len(frontier) > 0:
+        i = frontier.pop()
+        for j in level.neighbors[i]:
+            if j not in boxes or j in cluster:
+                continue
+            if j in level.goals:
+                cluster.add(j)
+                frontier.append(j)
+            else:
+                neighbors.add(j)
+    return neighbors
+
+def freeze_deadlock_detected(level, boxes, candidates = None):
+    """check if any box off of a goal can no longer be moved"""
+    if candidates is not None:
+        # boxes pushed onto goals aren't deadlocked themselves, but can
+        # still freeze the boxes around them
+        candidates = set(candidates).union(
+            *[goal_box_neighbors(level, boxes, box) for box in candidates
+              if box in level.goals])
+    for box in (boxes if candidates is None else candidates):
+        if box not in level.goals and box_frozen(level, boxes, box):
+            return True
+    return False
+
+def goal_matching_infeasible(level, boxes):
+    """check if boxes cannot be assigned to distinct goals that they could
+       each reach on an otherwise empty board (bipartite matching)
+    """
+    match = {}
+    def augment(box, seen):
+        for goal in level.goals:
+            if box in level.goal_reach[goal] and goal not in seen:
+                seen.add(goal)
+                if goal not in match or augment(match[goal], seen):
+                    match[goal] = box
+                    return True
+        return False
+
+    return not all([augment(box, set()) for box in boxes])
+
+def find_corrals(level, boxes, reachable):
+    """yield (free cells, boxes) of each area the player cannot reach"""
+    assigned = set()
+    for start in range(level.rows * level.cols):
+        if start in assigned or start in reachable or start in boxes or \
+           level.walls[start]:
+            continue
+
+        # flood fill over unreachable cells, including boxes
+        area = set([start])
+        frontier = [start]
+        while len(frontier) > 0:
+            i = frontier.pop()
+            for j in level.neighbors[i]:
+                if level.free(j) and j not in reachable and j not in area:
+                    area.add(j)
+                    frontier.append(j)
+        assigned |= area
+        yield area - boxes, area & boxes
+
+def corral_is_pi(level, boxes, reachable, cells, corral_boxes):
+    """a pi-corral is a corral where the player can reach a box on its
+       barrier, and every push of a barrier box moves it into the corral
+    """
+    barrier = [box for box in corral_boxes
+               if any([j in reachable for j in level.neighbors[box]])]
+    if len(barrier) == 0:
+        return False
+    for box in barrier:
+        for d in directions:
+            player = level.neighbors[box][(d + 2) % 4]
+            box_ = level.neighbors[box][d]
+            if player in reachable and level.free(box_, boxes) and \
+               box_ not in cells:
+                return False
+    return True
+
+def corral_deadlock_detected(level, boxes, player, max_nodes = 1000):
+    """check if some pi-corral can never be resolved. only the boxes of the
+       corral are kept, which can only make the puzzle easier, so it is a
+       deadlock if those boxes can't all be pushed onto goals
+    """
+    reachable = level.reachable(player, boxes)
+    for cells, corral_boxes in find_corrals(level, boxes, reachable):
+        if len(corral_boxes) == 0 or \
+           (corral_boxes <= level.goals and
+            all([cell not in level.goals for cell in cells])) or \
+           not corral_is_pi(level, boxes, reachable, cells, corral_boxes):
+            continue
+
+        if corral_unsolvable(level, frozenset(corral_boxes), player,
+                             cells, max_nodes):
+            return True
+    return False
+
+def corral_unsolvable(level, boxes, player, cells, max_nodes):
+    """breadth-first search over pushes of a subset of boxes. returns true
+       only if every reachable state has been explored without success
+    """
+    reachable = level.reachable(player, boxes)
+    visited = set([(boxes, min(reachable))])
+    frontier = [(boxes, reachable)]
+    while len(frontier) > 0:
+        if len(visited) > max_nodes:
+            return False
+        boxes, reachable = frontier.pop(0)
+
+        # the corral has been opened up, or all boxes have been placed
+        if boxes <= level.goals or not reachable.isdisjoint(cells):
+            return False
+
+        for box in boxes:
+            for d in directions:
+                player = level.neighbors[box][(d + 2) % 4]
+                box_ = level.neighbors[box][d]
+                if player not in reachable or \
+                   not level.free(box_, boxes) or box_ not in level.live:
+                    continue
+                boxes_ = boxes.difference([box]).union([box_])
+                reachable_ = level.reachable(box, boxes_)
+                state = (boxes_, min(reachable_))
+                if state not in visited:
+                    visited.add(state)
+                    frontier.append((boxes_, reachable_))
+    return True
+
+# heuristics
+
+class RuntimeDeadlockHeuristic(Heuristic):
+    """heuristic value is inf if a freeze deadlock, an infeasible goal
+       assignment, or an unsolvable pi-corral is detected, else 0
+    """
+    def __init__(self, freeze = True, matching = True, corral = True,
+                 corral_nodes = 1000):
+        super(RuntimeDeadlockHeuristic, self).__init__()
+        self.freeze = freeze
+        self.matching = matching
+        self.corral = corral
+        self.corral_nodes = corral_nodes
+
+        # pi-corrals are found from the region of the player
+        self.depends_on_player = corral
+
+    def _deadlocked(self, sokoban, candidates = None):
+        # boards without goals (e.g. deadlock basis generation) are skipped,
+        # since boxes are removed by pushing them off of the board there
+        if len(sokoban.goals) == 0:
+            return False
+
+        level = get_level(sokoban)
+        boxes = get_boxes(level, sokoban)
+        if self.freeze and \
+           freeze_deadlock_detected(level, boxes, candidates):
+            return True
+        if self.matching and goal_matching_infeasible(level, boxes):
+            return True
+        if self.corral and \
+           corral_deadlock_detected(level, boxes, level.index(sokoban.player),
+                                    self.corral_nodes):
+            return True
+        return False
+
+    def _evaluate(self, sokoban):
+        return inf if self._deadlocked(sokoban) else 0
+
+    def _evaluate_child(self, sokoban, parent, action):
+        # a new freeze deadlock must involve the box that was pushed
+        destination = action.destination
+        if not sokoban.board.in_bounds(destination):
+            return self._evaluate(sokoban)
+        level = get_level(sokoban)
+        return inf if self._deadlocked(sokoban, [level.index(destination)]) \
+               else 0
@@ -1,31 +1,77 @@
 # utility functions
 
+import re
+import itertools
+import numpy as np
+
 from constants import *
 from sokoban import *
 
 def parse_puzzle(file_path, game_encoding = microban_encoding):
-    array = []
-    game_decoding = {game_encoding[k] : k for k in game_encoding}
     with open(file_path, mode = "r", encoding = "utf-8") as f:
-        for line in f.readlines():
-            array.append([game_decoding.get(c, SPACE) for c in line])
+        return parse_level(f.readlines(), game_encoding)
+
+def parse_collection(file_path, game_encoding = microban_encoding):
+    """stream the levels of a file containing many levels, separated by
+       blank lines and titles / comments. rows may be run-length encoded
+       output: generator of (title, Sokoban) pairs
+    """
+    level_chars = set(game_encoding.values()) | set(alternative_decoding)
+    level_chars |= set("0123456789|()")
+    title = None
+    lines = []
+    with open(file_path, mode = "r", encoding = "utf-8") as f:
+        for line in itertools.chain(f, [""]):
+            line = line.rstrip("\r\n")
+
+            # level rows only contain level characters, incl. a wall
+            if "#" in line and set(line) <= level_chars:
+                lines.extend(rle_decode(line).split("|"))
+                continue
+            if len(lines) > 0:
+                yield title, parse_level(lines, game_encoding)
+                title = None
+                lines = []
+            if line.strip() != "":
+                title = line.strip().lstrip(";").strip()
+
+def rle_decode(line):
+    """expand run-length encoded rows, e.g. "3#2(-$)" -> "###-$-$" """
+    if not any([c.isdigit() for c in line]):
+        return line
+    def expand(match):
+        group = match.group(2)
+        if group.startswith("("):
+            group = rle_decode(group[1 : -1])
+        return group * int(match.group(1))
+    return re.sub(r"(\d+)(\([^()]*\)|.)", expand, line)
+
+def decoding_table(game_encoding = microban_encoding):
+    """translation table from each byte of a level to its object constants,
+       where unknown characters are decoded as spaces
+    """
+    table = bytearray(256)
+    for c, obj in itertools.chain(alternative_decoding.items(),
+                                  [(game_encoding[obj], obj)
+                                   for obj in game_encoding]):
+        table[ord(c)] = obj
+    return bytes(table)
 
+def parse_level(lines, game_encoding = microban_encoding):
+    """build a Sokoban object from the rows of a level"""
     # zero-pad the right side of each row to have equal width
-    max_length = max([len(row) for row in array])
-    array = [row + [SPACE] * (max_length - len(row)) for row in array]
-    board = Board((len(array), max_length))
-    board[:] = array
+    rows = [line.rstrip("\r\n").encode("ascii", "replace")
+            for line in lines]
+    max_length = max([len(row) for row in rows])
+    data = b"".join([row.ljust(max_length) for row in rows])
+    array = np.frombuffer(data.translate(decoding_table(game_encoding)),
+                          dtype = np.uint8).reshape(len(rows), max_length)
 
     # figure out where the player, goals are on the board
-    player = None
-    goals = []
-    for r, c in board.positions:
-        if board[r, c] & PLAYER:
-           player = Position(r, c)
-           board[r, c] ^= PLAYER
-        if board[r, c] & GOAL:
-            goals.append(Position(r, c))
-            board[r, c] ^= GOAL
+    board = Board.from_array(array & (WALL | BOX))
+    players = list(zip(*(array & PLAYER).nonzero()))
+    player = Position(*players[-1]) if len(players) > 0 else None
+    goals = [Position(r, c) for r, c in zip(*(array & GOAL).nonzero())]
     return Sokoban(board, player, goals)
 
 def parse_deadlock_table(file_path):
@@ -1,11 +1,18 @@
 from abc import ABC, abstractmethod
+import os
 import time
+import array
+import heapq
+import argparse
+import multiprocessing
 import numpy as np
 
 from random import *
 
 from constants import *
 from sokoban import *
+from solution import *
+from solver import *
 from util import *
 
 # classes
@@ -25,7 +32,7 @@ class I2AGenerator(Generator):
     
     def __init__(self, max_room_tries = 10, max_position_tries = 10,
                  max_action_depth = 300, total_positions = 10 ** 6,
-                 new_direction_prob = 0.35, walk_steps = 1.5):
+                 new_direction_prob = 0.35, walk_steps = 1.5, top_k = 1):
         self.max_room_tries     = max_room_tries
         self.max_position_tries = max_position_tries
         self.max_action_depth   = max_action_depth
@@ -33,6 +40,10 @@ class I2AGenerator(Generator):
         self.new_direction_prob = new_direction_prob
         self.walk_steps         = walk_steps
 
+        # number of highest scoring rooms kept while playing in reverse
+        self.top_k              = top_k
+        self.candidates         = []
+
     def generate(self, width = 10, height = 10, boxes = 4, state = None):
         if state is not None:
             seed(state)
@@ -63,88 +74,106 @@ class I2AGenerator(Generator):
 
             # randomly choose initial player position and goal positions
             for _ in range(self.max_position_tries):
-                board = board_room.copy()
-                spaces = list(board.spaces)
+                spaces = list(board_room.spaces)
                 if len(spaces) < 1 + boxes:
                     break
                 shuffle(spaces)
                 player = Position(*spaces[0])
                 goals = [Position(r, c) for (r, c) in spaces[1 : 1 + boxes]]
-                for goal in goals:
-                    board[goal] = BOX
 
                 # use dfs to play puzzle in reverse
-                moves = [(d, b) for d in directions.values()
-                         for b in (True, False)]
-                frontier = [(board, player, 0)]
-                visited = set(); visited.add((board, player))
-
-                # collect statistics about box movement, mapping from
-                # puzzle state to (id of last box moved, box_positions, # swaps)
-                box_positions = list(board.boxes)
-                goal_positions = box_positions.copy()
-                statistics = { (board, player) : (None, box_positions, 0) }
-                
-                while len(visited) < self.total_positions and len(frontier) > 0:
-                    board, player, depth = frontier.pop()
-
-                    if depth >= self.max_action_depth:
-                        continue
-                    
-                    last_box_moved, box_positions, box_swaps = \
-                        statistics[(board, player)]
-                    shuffle(moves)
-                    
-                    for direction, do_pull in moves:
-                        if board[player + direction] == SPACE:
-                            board_ = board.copy()
-                            player_ = player.copy()
-                            depth_ = depth + 1
-                            last_box_moved_ = last_box_moved
-                            box_pos_ = box_positions.copy()
-                            box_swaps_ = box_swaps
-                        
-                            # pull box towards player, if do_pull is true
-                            if do_pull and board[player - direction] == BOX:
-                                board_[player - direction] = SPACE
-                                board_[player] = BOX
-
-                                # keep track of identity of box when moved
-                                box_id = box_positions.index(player - direction)
-                                box_pos_[box_id] = tuple(player)
-                                if last_box_moved != None and \
-                                   last_box_moved != box_id:
-                                    box_swaps_ += 1
-                                last_box_moved_ = box_id
-                            player_ += direction
-
-                            if (board_, player_) not in visited:
-                                frontier.append((board_, player_, depth_))
-                                visited.add((board_, player_))
-
-                                statistics[(board_, player_)] = \
-                                    (last_box_moved_, box_pos_, box_swaps_)
-                            
-                def score(board, player, _, box_positions, box_swaps):
-                    # score is 0 whenever box or player is on top of goal
-                    if any([player == goal or board[goal] == BOX
-                            for goal in goals]):
-                        return 0
-
-                    box_displacements = [manhattan_dist(box, goal)
-                                         for box, goal in
-                                         zip(box_positions, goal_positions)]
-                    return box_swaps * sum(box_displacements)
-
-                # calculate scores, find room that maximizes score
-                board, player = max(statistics,
-                                    key = lambda k: score(*k, *statistics[k]))
-                best_score = score(board, player, *statistics[(board, player)])
-
-                if best_score <= 0:
+                best = self.reverse_play(board_room, player, goals)
+                if len(best) == 0 or best[-1][0] <= 0:
                     continue
 
-                return Sokoban(board, player, goals)
+                # rebuild the room w/ highest score from its packed state
+                self.candidates = [self.unpack(board_room, goals, candidate)
+                                   for candidate in reversed(best)]
+                return self.candidates[0]
+
+    def reverse_play(self, board_room, player, goals):
+        """dfs over states reached by walking + pulling boxes from the goals.
+           states are packed into bytes of flat cell indices, and only the
+           top_k highest scoring states are kept
+           output: sorted list of (score, -order, player, box cells)
+        """
+        cols = board_room.cols
+        walls = bytes(board_room.flatten() == WALL)
+        moves = [(d[0] * cols + d[1], b) for d in directions.values()
+                 for b in (True, False)]
+
+        # box identities are given by their index in the array of cells
+        goal_cells = array.array('H', [r * cols + c for r, c in
+                                       sorted(map(tuple, goals))])
+        player = player[0] * cols + player[1]
+        boxes = array.array('H', goal_cells)
+
+        def pack(player, boxes):
+            return array.array('H', [player] + sorted(boxes)).tobytes()
+
+        def score(player, boxes, box_swaps):
+            # score is 0 whenever box or player is on top of goal
+            if player in goal_cells or \
+               any([box in goal_cells for box in boxes]):
+                return 0
+
+            box_displacements = [manhattan_dist(divmod(box, cols),
+                                                divmod(goal, cols))
+                                 for box, goal in zip(boxes, goal_cells)]
+            return box_swaps * sum(box_displacements)
+
+        # frontier entries are (player, box cells, id of last box moved,
+        # # swaps, depth), and best is a min-heap of the top scoring states
+        frontier = [(player, boxes, None, 0, 0)]
+        visited = set([pack(player, boxes)])
+        best = [(score(player, boxes, 0), -1, player, boxes.tobytes())]
+
+        while len(visited) < self.total_positions and len(frontier) > 0:
+            player, boxes, last_box_moved, box_swaps, depth = frontier.pop()
+
+            if depth >= self.max_action_depth:
+                continue
+
+            shuffle(moves)
+            for step, do_pull in moves:
+                player_ = player + step
+                if walls[player_] or player_ in boxes:
+                    continue
+                boxes_ = boxes
+                last_box_moved_ = last_box_moved
+                box_swaps_ = box_swaps
+
+                # pull box towards player, if do_pull is true
+                if do_pull and player - step in boxes:
+                    # keep track of identity of box when moved
+                    box_id = boxes.index(player - step)
+                    boxes_ = array.array('H', boxes)
+                    boxes_[box_id] = player
+                    if last_box_moved != None and last_box_moved != box_id:
+                        box_swaps_ += 1
+                    last_box_moved_ = box_id
+
+                key = pack(player_, boxes_)
+                if key not in visited:
+                    visited.add(key)
+                    frontier.append((player_, boxes_, last_box_moved_,
+                                     box_swaps_, depth + 1))
+
+                    candidate = (score(player_, boxes_, box_swaps_),
+                                 -len(visited), player_, boxes_.tobytes())
+                    if len(best) < self.top_k:
+                        heapq.heappush(best, candidate)
+                    elif candidate > best[0]:
+                        heapq.heapreplace(best, candidate)
+
+        return sorted(best)
+
+    def unpack(self, board_room, goals, candidate):
+        _, _, player, boxes = candidate
+        board = board_room.copy()
+        for box in array.array('H', boxes):
+            board[divmod(box, board.cols)] = BOX
+        return Sokoban(board, Position(*divmod(player, board.cols)), goals)
 
 def generate_and_store_i2a(i_min, i_max):
     gen = I2AGenerator()
@@ -154,3 +183,109 @@ def generate_and_store_i2a(i_min, i_max):
                   mode = "w", encoding = "utf-8") as f:
             out = f.write(str(sokoban))
             
+
+def puzzle_seed(base_seed, i):
+    """seed for puzzle i, independent of which worker generates it"""
+    return base_seed * 10 ** 9 + i
+
+def generate_puzzle(task):
+    """generate (and optionally solve) a single puzzle in a worker process
+       input: (puzzle index, seed, keyword arguments of generate_bulk)
+       output: (puzzle index, sokoban or None, canonical hash, solution len,
+                solution as a LURD string)
+    """
+    i, state, options = task
+    gen = I2AGenerator(**options["generator_options"])
+    sokoban = gen.generate(options["width"], options["height"],
+                           options["boxes"], state = state)
+    if sokoban is None:
+        return i, None, None, None, None
+
+    # optionally reject puzzles that are too easy for a fast solver
+    length = moves = None
+    if options["min_solution_length"] is not None:
+        solver = AStarSolver(MinMatchingHeuristic())
+        solution = solver.solve(sokoban, max_nodes = options["max_solve_nodes"],
+                                state = state)
+        if solution is None:
+            return i, None, None, None, None
+        length = len(solution) // 2
+        if length < options["min_solution_length"]:
+            return i, None, None, None, None
+        moves = to_lurd(sokoban, solution)
+    return i, sokoban, sokoban.canonical_hash(), length, moves
+
+def generate_bulk(i_min, i_max, puzzle_dir = "puzzles/i2a_generated",
+                  index_file = None, processes = None, base_seed = 0,
+                  width = 10, height = 10, boxes = 4,
+                  min_solution_length = None, max_solve_nodes = 10 ** 4,
+                  generator_options = {}, quiet = True):
+    """generate puzzles i_min ... i_max in parallel, each w/ its own seed so
+       that runs are reproducible, and store the ones that are new
+       (up to rotation / reflection) as puzzle_dir/gen_<n>.txt
+       output: number of puzzles stored
+    """
+    index_file = index_file or puzzle_dir.rstrip("/") + "_index.txt"
+    os.makedirs(puzzle_dir, exist_ok = True)
+
+    # index has one line of "hash puzzle_number seed solution_len moves" per
+    # puzzle, where moves is a LURD string (or "-" if not solved)
+    hashes = set()
+    n = 0
+    if os.path.exists(index_file):
+        with open(index_file, mode = "r", encoding = "utf-8") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) > 0:
+                    hashes.add(fields[0])
+                    n = max(n, int(fields[1]))
+
+    options = { "width" : width, "height" : height, "boxes" : boxes,
+                "min_solution_length" : min_solution_length,
+                "max_solve_nodes" : max_solve_nodes,
+                "generator_options" : generator_options }
+    tasks = [(i, puzzle_seed(base_seed, i), options)
+             for i in range(i_min, i_max + 1)]
+
+    stored = 0
+    with multiprocessing.Pool(processes) as pool, \
+         open(index_file, mode = "a", encoding = "utf-8") as index:
+        # results arrive in order, so deduplication is deterministic
+        for i, sokoban, key, length, moves in pool.imap(generate_puzzle, tasks,
+                                                 chunksize = 4):
+            if sokoban is None or key in hashes:
+                quiet or print("skipped puzzle #" + str(i), flush = True)
+                continue
+            hashes.add(key)
+            n += 1
+            stored += 1
+            with open(puzzle_dir + "/gen_%d.txt" % n,
+                      mode = "w", encoding = "utf-8") as f:
+                f.write(str(sokoban))
+            index.write("%s %d %d %s %s\n" % (key, n,
+                                              puzzle_seed(base_seed, i),
+                                              length, moves or "-"))
+            quiet or print("stored puzzle #" + str(n), flush = True)
+    return stored
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description = "generate puzzles in bulk w/ I2AGenerator")
+    parser.add_argument("i_min", type = int)
+    parser.add_argument("i_max", type = int)
+    parser.add_argument("--puzzle-dir", default = "puzzles/i2a_generated")
+    parser.add_argument("--index-file", default = None)
+    parser.add_argument("--processes", type = int, default = None)
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--width", type = int, default = 10)
+    parser.add_argument("--height", type = int, default = 10)
+    parser.add_argument("--boxes", type = int, default = 4)
+    parser.add_argument("--total-positions", type = int, default = 10 ** 6)
+    parser.add_argument("--min-solution-length", type = int, default = None)
+    parser.add_argument("--max-solve-nodes", type = int, default = 10 ** 4)
+    args = parser.parse_args()
+
+    generate_bulk(args.i_min, args.i_max, args.puzzle_dir, args.index_file,
+                  args.processes, args.seed, args.width, args.height,
+                  args.boxes, args.min_solution_length, args.max_solve_nodes,
+                  { "total_positions" : args.total_positions }, quiet = False)
@@ -0,0 +1,169 @@
+# macro pushes through tunnels and into goal rooms
+
+from constants import *
+from detector import *
+from sokoban import *
+
+# functions
+
+def position_of(level, i):
+    return Position(*divmod(i, level.cols))
+
+def push_path(level, box, player, target, boxes):
+    """shortest sequence of pushes that moves a lone box from box to target,
+       w/ the player starting at player and other boxes held in place
+       output: list of (box cell, direction) pairs, or None if impossible
+    """
+    if box in boxes:
+        return None
+    reachable = level.reachable(player, boxes | set([box]))
+    start = (box, min(reachable))
+    prev = { start : None }
+    frontier = [(box, reachable)]
+    while len(frontier) > 0:
+        box, reachable = frontier.pop(0)
+        if box == target:
+            path = []
+            state = (box, min(reachable))
+            while prev[state] is not None:
+                state, push = prev[state]
+                path = [push] + path
+            return path
+
+        for d in directions:
+            player = level.neighbors[box][(d + 2) % 4]
+            box_ = level.neighbors[box][d]
+            if player not in reachable or not level.free(box_, boxes):
+                continue
+            reachable_ = level.reachable(box, boxes | set([box_]))
+            state = (box_, min(reachable_))
+            if state not in prev:
+                prev[state] = ((box, min(reachable)), (box, d))
+                frontier.append((box_, reachable_))
+    return None
+
+# classes
+
+class GoalRoom:
+    """area that contains goals and can only be entered through one cell.
+       boxes are pushed into the room from entrance in direction d, and
+       are sent straight to the goals in fill_order
+    """
+    def __init__(self, entrance, d, cells, fill_order):
+        self.entrance = entrance
+        self.d = d
+        self.cells = cells
+        self.fill_order = fill_order
+
+class MacroMoves:
+    """replaces single box pushes with macro pushes, w/ static analysis
+       of tunnels and goal rooms done once per puzzle
+    """
+    def __init__(self, sokoban, tunnels = True, goal_rooms = True):
+        self.level = level = Level(sokoban)
+        self.tunnels = tunnels
+
+        # entry cells of goal rooms, mapping from { (cell, d) : GoalRoom }
+        self.rooms = {}
+        if goal_rooms:
+            for room in self.find_goal_rooms():
+                self.rooms[(level.neighbors[room.entrance][room.d],
+                            room.d)] = room
+
+    def in_tunnel(self, i, d):
+        """check if both sides of cell i perpendicular to d are blocked"""
+        level = self.level
+        return level.free(i) and \
+               not any([level.free(level.neighbors[i][(d + k) % 4])
+                        for k in (1, 3)])
+
+    def find_goal_rooms(self):
+        level = self.level
+        floor = [i for i in range(level.rows * level.cols) if level.free(i)]
+        rooms = []
+        for entrance in floor:
+            if entrance in level.goals:
+                continue
+            for d in directions:
+                start = level.neighbors[entrance][d]
+                if not level.free(start) or \
+                   any([start in room.cells for room in rooms]):
+                    continue
+
+                # room is the area behind the entrance, if it has no exits
+                cells = level.reachable(start, set([entrance]))
+                goals = cells & level.goals
+                if len(goals) < 2 or len(goals) == len(level.goals) and \
+                   len(cells) + 1 == len(floor):
+                    continue
+                if any([level.neighbors[entrance][d_] in cells
+                        for d_ in directions if d_ != d]):
+                    continue
+
+                fill_order = self.find_fill_order(entrance, start, goals)
+                if fill_order is not None:
+                    rooms.append(GoalRoom(entrance, d, cells, fill_order))
+        return rooms
+
+    def find_fill_order(self, entrance, start, goals):
+        """order in which boxes entering the room can be placed on its goals,
+           found by repeatedly choosing a goal to be filled last
+        """
+        goals = set(goals)
+        fill_order = []
+        while len(goals) > 0:
+            for goal in sorted(goals):
+                others = goals - set([goal])
+                if push_path(self.level, start, entrance, goal,
+                             others) is not None:
+                    fill_order = [goal] + fill_order
+                    goals = others
+                    break
+            else:
+                return None
+        return fill_order
+
+    def extend(self, sokoban, action):
+        """list of single pushes that follow from the given push"""
+        level = self.level
+        box = level.index(action.box_position)
+        d = next(d for d in directions
+                 if directions[d] == tuple(action.direction))
+        box_ = level.neighbors[box][d]
+        steps = [(box, d)]
+        if box_ is None:
+            return steps
+
+        room = self.rooms.get((box_, d))
+        if room is not None:
+            # send box straight to the next unfilled goal of the room
+            boxes = get_boxes(level, sokoban) - set([box])
+            placed = boxes & room.cells
+            n = len(placed)
+            if n < len(room.fill_order) and \
+               placed == set(room.fill_order[: n]):
+                path = push_path(level, box_, box, room.fill_order[n], boxes)
+                if path is not None:
+                    return steps + path
+
+        if self.tunnels:
+            # keep pushing while box + player are both inside a tunnel
+            boxes = get_boxes(level, sokoban)
+            while box_ not in level.goals and \
+                  self.in_tunnel(box_, d) and self.in_tunnel(box, d):
+                box, box_ = box_, level.neighbors[box_][d]
+                if not level.free(box_, boxes):
+                    break
+                steps.append((box, d))
+        return steps
+
+    def neighbors(self, sokoban):
+        for action in sokoban.get_push_actions():
+            steps = self.extend(sokoban, action)
+            if len(steps) > 1:
+                action = MacroPushAction([
+                    BoxPushAction(position_of(self.level, box), directions[d])
+                    for box, d in steps])
+            sokoban_ = sokoban.copy()
+            action.act(sokoban_)
+            yield sokoban_, action
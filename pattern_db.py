@@ -0,0 +1,235 @@
+# additive pattern databases, built per puzzle and cached on disk
+
+import os
+import json
+import hashlib
+import itertools
+import multiprocessing
+import numpy as np
+
+from math import *
+
+from constants import *
+from detector import *
+from sokoban import *
+from solver import *
+from util import *
+
+# bump whenever the layout or the contents of a database change
+PATTERN_DB_VERSION = 2
+
+pattern_db_cache_dir = ".pattern_db_cache"
+
+# entries of unreachable placements. distances are capped one below, which
+# keeps the database admissible for placements that are even farther
+UNREACHABLE = 255
+
+# functions
+
+def binomials(n, k):
+    """table[i, j] = (i choose j) for i < n, j <= k"""
+    table = np.zeros((n + 1, k + 1), dtype = np.int64)
+    table[:, 0] = 1
+    for i in range(1, n + 1):
+        table[i, 1 :] = table[i - 1, 1 :] + table[i - 1, : -1]
+    return table
+
+def placement_rank(cells, table):
+    """index of sorted tuples of cells in colex order, works on a (M, k)
+       array of placements at once
+    """
+    cells = np.asarray(cells, dtype = np.int64)
+    return sum([table[cells[..., j], j + 1] for j in range(cells.shape[-1])])
+
+def partition_goals(level, group_size = 2):
+    """split goals into groups of up to group_size, where each group is
+       grown from its first goal by adding the nearest remaining goals
+    """
+    goals = sorted(level.goals)
+    groups = []
+    while len(goals) > 0:
+        group = [goals.pop(0)]
+        while len(group) < group_size and len(goals) > 0:
+            nearest = min(goals, key = lambda goal: min(
+                [manhattan_dist(divmod(goal, level.cols),
+                                divmod(g, level.cols)) for g in group]))
+            goals.remove(nearest)
+            group.append(nearest)
+        groups.append(sorted(group))
+    return groups
+
+def build_group_table(task):
+    """exact number of pushes to move boxes from each placement onto the
+       goals of one group, w/ all other boxes removed + the player free to
+       go anywhere. found by breadth-first search over pulls from the goals
+       input: (neighbors of each cell, floor cells, goals of the group)
+       output: uint8 array indexed by placement_rank of floor indices
+    """
+    neighbors, floor, group = task
+    index = { cell : i for i, cell in enumerate(floor) }
+    k = len(group)
+    table = binomials(len(floor), k)
+    distances = np.full(table[len(floor), k], UNREACHABLE, dtype = np.uint8)
+
+    start = tuple(sorted([index[goal] for goal in group]))
+    distances[placement_rank(start, table)] = 0
+    frontier = [start]
+    distance = 0
+    while len(frontier) > 0:
+        distance += 1
+        frontier_ = []
+        for boxes in frontier:
+            occupied = set(boxes)
+            for n, box in enumerate(boxes):
+                for d in directions:
+                    # box moves to box_, pulled by a player standing beyond
+                    box_ = neighbors[floor[box]][d]
+                    if box_ is None or box_ not in index or \
+                       index[box_] in occupied:
+                        continue
+                    player = neighbors[box_][d]
+                    if player is None or player not in index or \
+                       index[player] in occupied:
+                        continue
+                    boxes_ = tuple(sorted(boxes[: n] + (index[box_],) +
+                                          boxes[n + 1 :]))
+                    rank = placement_rank(boxes_, table)
+                    if distances[rank] == UNREACHABLE:
+                        distances[rank] = min(distance, UNREACHABLE - 1)
+                        frontier_.append(boxes_)
+        frontier = frontier_
+    return distances
+
+def level_key(level, group_size):
+    """hash of walls, goals, and settings, shared by every state of a puzzle"""
+    digest = hashlib.sha1()
+    digest.update(json.dumps({ "version" : PATTERN_DB_VERSION,
+                               "shape" : [level.rows, level.cols],
+                               "goals" : sorted(level.goals),
+                               "group_size" : group_size }).encode("utf-8"))
+    digest.update(bytes(level.walls))
+    return digest.hexdigest()
+
+# classes
+
+class PatternDatabase:
+    """additive pattern database of one puzzle. goals are split into groups,
+       and each group has a table of exact push costs for every placement of
+       as many boxes as it has goals
+    """
+    def __init__(self, level, group_size = 2, cache_dir = pattern_db_cache_dir,
+                 processes = None):
+        self.level = level
+        self.floor = [i for i in range(level.rows * level.cols)
+                      if not level.walls[i]]
+        self.index = np.full(level.rows * level.cols, -1, dtype = np.int64)
+        self.index[self.floor] = np.arange(len(self.floor))
+
+        key = level_key(level, group_size)
+        path = None if cache_dir is None else \
+               os.path.join(cache_dir, key + ".npz")
+        if path is not None and os.path.exists(path):
+            with np.load(path) as arrays:
+                self.groups = [[goal for goal in group if goal >= 0]
+                               for group in arrays["groups"].tolist()]
+                self.tables = [arrays["table_%d" % i]
+                               for i in range(len(self.groups))]
+        else:
+            self.groups = partition_goals(level, group_size)
+            self.tables = self.build(processes)
+            if path is not None:
+                self.save(path)
+
+        self.binomials = binomials(len(self.floor),
+                                   max([len(g) for g in self.groups] + [1]))
+
+    def build(self, processes = None):
+        tasks = [(self.level.neighbors, self.floor, group)
+                 for group in self.groups]
+        if processes == 1 or len(tasks) < 2:
+            return list(map(build_group_table, tasks))
+        with multiprocessing.Pool(min(processes or os.cpu_count(),
+                                      len(tasks))) as pool:
+            return pool.map(build_group_table, tasks)
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok = True)
+        # groups may differ in size, so they are padded w/ -1
+        size = max([len(group) for group in self.groups] + [1])
+        groups = np.array([group + [-1] * (size - len(group))
+                           for group in self.groups], dtype = np.int64)
+        with open(path + ".tmp", mode = "wb") as f:
+            np.savez(f, groups = groups, **{ "table_%d" % i : table
+                                             for i, table
+                                             in enumerate(self.tables) })
+        os.replace(path + ".tmp", path)
+
+    def group_costs(self, boxes, i):
+        """(masks of boxes, costs) of every placement of boxes on group i"""
+        k = len(self.groups[i])
+        combos = np.array(list(itertools.combinations(range(len(boxes)), k)),
+                          dtype = np.int64).reshape(-1, k)
+        cells = np.sort(boxes[combos], axis = 1)
+        costs = self.tables[i][placement_rank(cells, self.binomials)] \
+                .astype(float)
+        costs[costs == UNREACHABLE] = inf
+        masks = (1 << combos).sum(axis = 1)
+        return masks, costs
+
+    def lower_bound(self, boxes, max_exact_boxes = 16):
+        """least total cost of assigning boxes to groups, where each group
+           gets as many boxes as it has goals. above max_exact_boxes, groups
+           may share boxes, which is weaker but still a lower bound
+        """
+        boxes = self.index[np.asarray(boxes, dtype = np.int64)]
+        n = len(boxes)
+        if n > max_exact_boxes:
+            return sum([self.group_costs(boxes, i)[1].min(initial = inf)
+                        for i in range(len(self.groups))])
+
+        # dynamic programming over subsets of boxes, one group at a time
+        subsets = np.arange(1 << n)
+        values = np.full(1 << n, inf)
+        values[0] = 0
+        for i in range(len(self.groups)):
+            values_ = np.full(1 << n, inf)
+            for mask, cost in zip(*self.group_costs(boxes, i)):
+                if cost == inf:
+                    continue
+                free = (subsets & mask) == 0
+                targets = subsets[free] | mask
+                values_[targets] = np.minimum(values_[targets],
+                                              values[free] + cost)
+            values = values_
+        return values[(1 << n) - 1]
+
+class PatternDatabaseHeuristic(Heuristic):
+    """sum of exact costs of groups of goals, from a pattern database that
+       is built once per puzzle (and cached on disk). admissible, and inf
+       if boxes can't be assigned to goals at all
+    """
+    def __init__(self, group_size = 2, cache_dir = pattern_db_cache_dir,
+                 processes = None, max_exact_boxes = 16):
+        super(PatternDatabaseHeuristic, self).__init__()
+        self.group_size = group_size
+        self.cache_dir = cache_dir
+        self.processes = processes
+        self.max_exact_boxes = max_exact_boxes
+        self.databases = LRUCache(max_entries = 16)
+
+    def database(self, sokoban):
+        level = get_level(sokoban)
+        database = self.databases.get(id(level))
+        if database is None or database.level is not level:
+            database = PatternDatabase(level, self.group_size, self.cache_dir,
+                                       self.processes)
+            self.databases.put(id(level), database)
+        return database
+
+    def _evaluate(self, sokoban):
+        boxes = [box[0] * sokoban.board.cols + box[1]
+                 for box in sokoban.board.boxes]
+        # w/o one goal per box, boxes don't have to be assigned to groups
+        if len(boxes) != len(sokoban.goals) or len(boxes) == 0:
+            return 0
+        return self.database(sokoban).lower_bound(boxes, self.max_exact_boxes)
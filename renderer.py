@@ -6,89 +6,237 @@ import curses
 from random import *
 
 from constants import *
+from corpus import *
 from file import *
 from generator import *
 from sokoban import *
 from solver import *
+from worker import *
 
 # classes
 
+class BufferWindow:
+    """in-memory stand-in for a curses window, for headless rendering"""
+    def __init__(self, height = HEIGHT, width = WIDTH):
+        self.height = height
+        self.width = width
+        self.erase()
+
+    def addch(self, r, c, char):
+        self.cells[r][c] = char
+
+    def addstr(self, r, c, text):
+        for k, char in enumerate(text[: self.width - c]):
+            self.cells[r][c + k] = char
+
+    def erase(self):
+        self.cells = [[" "] * self.width for _ in range(self.height)]
+
+    def refresh(self):
+        pass
+
+    def __str__(self):
+        return "\n".join(["".join(row).rstrip() for row in self.cells])
+
+class Renderer:
+    """draws boards into a window, keeping the previous frame so that only
+       cells that changed (usually the player + one box) are redrawn.
+       renders into a BufferWindow if no window is given
+    """
+    def __init__(self, window = None, encoding = microban_encoding):
+        self.window = BufferWindow() if window is None else window
+        self.chars = { obj : encoding[obj] for obj in encoding }
+        self.frame = None
+        self.offset = None
+        self.lines = {}
+
+    def grid(self, sokoban):
+        # object of each cell, encoded the same way as Sokoban.to_str
+        grid = np.array(sokoban.board, dtype = np.uint8)
+        if sokoban.player is not None and \
+           sokoban.player.in_bounds(*sokoban.board.bounds):
+            grid[tuple(sokoban.player)] = PLAYER
+        for goal in sokoban.goals:
+            grid[goal.row, goal.col] |= GOAL
+        return grid
+
+    def render(self, sokoban):
+        """draw sokoban, output: number of cells that were redrawn"""
+        grid = self.grid(sokoban)
+        if self.frame is None or self.frame.shape != grid.shape:
+            return self.render_full(sokoban, grid)
+
+        r_off, c_off = self.offset
+        changed = list(zip(*(grid != self.frame).nonzero()))
+        for r, c in changed:
+            self.window.addch(r_off + r, c_off + c, self.chars[grid[r, c]])
+        self.frame = grid
+        if len(changed) > 0:
+            self.window.refresh()
+        return len(changed)
+
+    def render_full(self, sokoban, grid = None):
+        grid = self.grid(sokoban) if grid is None else grid
+        self.window.erase()
+        self.lines = {}
+        render_legend(self.window)
+        self.offset = r_off, c_off = ((HEIGHT - grid.shape[0]) // 2,
+                                      (WIDTH - grid.shape[1]) // 2)
+        for r, row in enumerate(grid):
+            for c, obj in enumerate(row):
+                self.window.addch(r_off + r, c_off + c, self.chars[obj])
+        self.frame = grid
+        self.window.refresh()
+        return grid.size
+
+    def status(self, r, text):
+        """write a line of text at row r, erasing what was there before"""
+        text = text or ""
+        previous = self.lines.get(r, "")
+        if text == previous:
+            return
+        self.window.addstr(r, 0, text.ljust(len(previous)))
+        self.lines[r] = text
+        self.window.refresh()
+
+    def replay(self, sokoban, pushes, fps = 30, sleep = time.sleep):
+        """play a solution back at fps frames per second, w/ one push per
+           frame. sokoban is modified in place
+        """
+        self.render(sokoban)
+        for push in pushes:
+            sleep(1 / fps)
+            play_push(sokoban, push)
+            self.render(sokoban)
+        return sokoban
+
+def play_push(sokoban, push):
+    push.act(sokoban)
+    # keep the player behind the box, instead of normalized
+    sokoban.player = push.box_position.copy()
+
 def render_legend(window):
     window.addstr((HEIGHT // 2) - 2, WIDTH - 16, "# [wall]")
     window.addstr((HEIGHT // 2) - 1, WIDTH - 16, "@ [player]")
     window.addstr((HEIGHT // 2) - 0, WIDTH - 16, "$ [box]")
     window.addstr((HEIGHT // 2) + 1, WIDTH - 16, ". [goal]")
     window.addstr((HEIGHT // 2) + 2, WIDTH - 16, "* [box on goal]")
-    window.refresh()
-
-def render_board(window, sokoban, encoding = microban_encoding):
-    window.clear()
-    r_off = (HEIGHT - sokoban.board.rows) // 2
-    c_off = (WIDTH - sokoban.board.cols) // 2
-    for r, row in enumerate(sokoban.to_str(encoding).split("\n")):
-        for c, char in enumerate(row):
-            window.addch(r_off + r, c_off + c, char)
-            
-    window.refresh()
-
-def play_game(stdscr):
+
+game_keys = [curses.KEY_UP, curses.KEY_RIGHT, curses.KEY_DOWN, curses.KEY_LEFT,
+             ord('r'), ord('w'), ord('e'), ord('g'), ord('s'), ord('q')]
+
+def play_game(stdscr, fps = 10):
     puzzle_directory = "puzzles/i2a_generated"
-    def load(puzzle_n):
-        return parse_puzzle(puzzle_directory + "/gen_" +
-                            str(puzzle_n) + ".txt")
+    puzzle_corpus = puzzle_directory + ".corpus"
+    corpus = None
+    if os.path.exists(puzzle_corpus):
+        # read puzzles from packed corpus, if one has been built
+        corpus = Corpus(puzzle_corpus)
+        def load(puzzle_n):
+            return corpus[puzzle_n - 1]
+        total_puzzles = len(corpus)
+    else:
+        def load(puzzle_n):
+            return parse_puzzle(puzzle_directory + "/gen_" +
+                                str(puzzle_n) + ".txt")
+        total_puzzles = len(os.listdir(puzzle_directory))
     puzzle_n = 1
-    total_puzzles = len(os.listdir(puzzle_directory))
     sokoban = load(puzzle_n)
 
-    gen = I2AGenerator(total_positions = 10 ** 4)
+    # generation + solving run in the background, while the loop below
+    # wakes up every frame to poll for their results
+    worker = GameWorker(generator_options = { "total_positions" : 10 ** 4 })
+    stdscr.timeout(1000 // fps)
 
     window = stdscr.derwin(HEIGHT, WIDTH, 0, 0)
-    window.clear()
+    renderer = Renderer(window)
+
+    # pushes of the solution being played back, if any
+    playback = []
+    waiting_for_puzzle = False
+    title = None
+    status = None
 
     char = None
-    while True:
-        solved_flag = None
-        if sokoban.solved():
-            solved_flag = puzzle_n
-            puzzle_n = min(puzzle_n + 1, total_puzzles)
-            sokoban = load(puzzle_n)
-        render_board(window, sokoban)
-        render_legend(window)
-        window.addstr(0, 0, "Puzzle #" + str(puzzle_n))
-        window.refresh()
-        if solved_flag:
-            window.addstr(0, 0, "Solved puzzle #" + str(solved_flag) + "!")
-            window.refresh()
-        char = stdscr.getch()
-
-        action = None
-        if char == curses.KEY_UP:
-            action = KeyboardAction(UP)
-        elif char == curses.KEY_RIGHT:
-            action = KeyboardAction(RIGHT)
-        elif char == curses.KEY_DOWN:
-            action = KeyboardAction(DOWN)
-        elif char == curses.KEY_LEFT:
-            action = KeyboardAction(LEFT)
-        elif char == ord('r'):
-            sokoban = load(puzzle_n)
-        elif char == ord('w'):
-            puzzle_n = ((puzzle_n - 2) % total_puzzles) + 1
-            sokoban = load(puzzle_n)
-        elif char == ord('e'):
-            puzzle_n = (puzzle_n % total_puzzles) + 1
-            sokoban = load(puzzle_n)
-        elif char == ord('g'):
-            window.addstr(0, 0, "Generating new puzzle...")
-            window.refresh()
-            sokoban = gen.generate()
-        elif char == ord('q'):
-            break
-        else:
-            continue
-
-        if action:
-            action.act(sokoban)
+    try:
+        while True:
+            # check on the worker every frame, even while keys are pressed
+            if waiting_for_puzzle:
+                generated = worker.next_puzzle()
+                if generated is not None:
+                    sokoban = generated
+                    waiting_for_puzzle = False
+                    status = None
+            done, solution = worker.poll_solution()
+            if done:
+                playback = [] if solution is None else solution
+                status = "No solution found" if solution is None else \
+                         "Solution: " + str(len(solution)) + " pushes"
+
+            if sokoban.solved():
+                title = "Solved puzzle #" + str(puzzle_n) + "!"
+                puzzle_n = min(puzzle_n + 1, total_puzzles)
+                sokoban = load(puzzle_n)
+                playback = []
+            renderer.render(sokoban)
+            renderer.status(0, title or "Puzzle #" + str(puzzle_n))
+            renderer.status(1, status)
+            char = stdscr.getch()
+
+            if char == -1:
+                # no key pressed during this tick, so play back a push
+                if len(playback) > 0:
+                    play_push(sokoban, playback.pop(0))
+                continue
+
+            if char not in game_keys:
+                continue
+
+            # any command interrupts solving, playback of a solution, and
+            # waiting for a generated puzzle (which would replace the level
+            # the player went to)
+            worker.cancel()
+            waiting_for_puzzle = False
+            playback = []
+            title = None
+            status = None
+
+            action = None
+            if char == curses.KEY_UP:
+                action = KeyboardAction(UP)
+            elif char == curses.KEY_RIGHT:
+                action = KeyboardAction(RIGHT)
+            elif char == curses.KEY_DOWN:
+                action = KeyboardAction(DOWN)
+            elif char == curses.KEY_LEFT:
+                action = KeyboardAction(LEFT)
+            elif char == ord('r'):
+                sokoban = load(puzzle_n)
+            elif char == ord('w'):
+                puzzle_n = ((puzzle_n - 2) % total_puzzles) + 1
+                sokoban = load(puzzle_n)
+            elif char == ord('e'):
+                puzzle_n = (puzzle_n % total_puzzles) + 1
+                sokoban = load(puzzle_n)
+            elif char == ord('g'):
+                generated = worker.next_puzzle()
+                if generated is None:
+                    waiting_for_puzzle = True
+                    status = "Generating new puzzle..."
+                else:
+                    sokoban = generated
+            elif char == ord('s'):
+                worker.solve(sokoban)
+                status = "Solving..."
+            elif char == ord('q'):
+                break
+
+            if action:
+                action.act(sokoban)
+    finally:
+        worker.close()
+        if corpus is not None:
+            corpus.close()
 
 if __name__ == "__main__":
     curses.wrapper(play_game)
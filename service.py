@@ -0,0 +1,487 @@
+# long-running local solving service (json lines over a unix socket or
+# a loopback tcp port), w/ a priority queue + a pool of warm workers
+
+import os
+import json
+import time
+import heapq
+import signal
+import socket
+import asyncio
+import argparse
+import itertools
+import multiprocessing
+
+from math import *
+
+from constants import *
+from deadlock import *
+from file import *
+from solution import *
+from solver import *
+from table import *
+from util import *
+
+# only loaded by workers that get a job w/ a pattern database heuristic
+pattern_db = lazy_import("pattern_db")
+
+service_socket = "/tmp/sokoban_solver.sock"
+
+# heuristics + solvers that jobs can ask for by name
+heuristics = {
+    "none"      : lambda: NoHeuristic(),
+    "boxes"     : lambda: RemainingBoxesHeuristic(),
+    "manhattan" : lambda: ManhattanDistHeuristic(),
+    "matching"  : lambda: MinMatchingHeuristic(),
+    # workers are daemonic, so they can't start a pool of their own
+    "pdb"       : lambda: pattern_db.PatternDatabaseHeuristic(processes = 1),
+}
+
+solvers = {
+    "astar"     : AStarSolver,
+    "greedy"    : GreedyBestFSSolver,
+    "ara"       : ARAStarSolver,
+}
+
+# worker processes
+
+def run_job(conn, job, deadlock_table):
+    """solve one job, sending (job id, event) messages back over conn"""
+    start_time = time.time()
+    try:
+        sokoban = parse_level([line for line in job["puzzle"].splitlines()
+                               if line.strip() != ""])
+        heuristic = heuristics[job.get("heuristic", "manhattan")]()
+        learner = None
+        if job.get("deadlock", True) and deadlock_table is not None:
+            # learned patterns are kept in the worker's table, for later jobs
+            if job.get("learn", False):
+                learner = LearningDeadlockHeuristic(deadlock_table)
+            heuristic = heuristic.max(
+                learner or DynamicDeadlockHeuristic(deadlock_table))
+        solver = solvers[job.get("solver", "astar")](heuristic)
+        max_nodes = job.get("max_nodes", 10 ** 5)
+
+        solution = None
+        if isinstance(solver, ARAStarSolver):
+            # stream every improved solution as progress
+            for solution, bound in solver.solutions(
+                    sokoban, max_nodes, time_limit = job.get("time_limit")):
+                conn.send((job["id"], { "event" : "progress",
+                                        "pushes" : len(solution) // 2,
+                                        "bound" : bound,
+                                        "time" : time.time() - start_time }))
+        else:
+            solution = solver.solve(sokoban, max_nodes,
+                                    max_bytes = job.get("max_bytes"),
+                                    time_limit = job.get("time_limit"))
+
+        result = { "event" : "result", "solved" : solution is not None,
+                   "status" : solver.status,
+                   "nodes" : len(getattr(solver, "visited", ())),
+                   "time" : time.time() - start_time }
+        if solution is not None:
+            result["pushes"] = len(solution) // 2
+            result["moves"] = to_lurd(sokoban, solution)
+        if learner is not None:
+            # patterns are saved by the service, see SolverService.learned
+            result["learned"] = learner.learned
+    except Exception as e:
+        # errors are reported to the client, and the worker stays warm
+        conn.send((job["id"], { "event" : "error", "message" : repr(e) }))
+        return
+    conn.send((job["id"], result))
+
+def worker_main(conn, deadlock_basis_file):
+    # imports + tables are loaded once, before the first job arrives
+    for module in [measure, optimize]:
+        preload(module)
+    deadlock_table = None
+    if deadlock_basis_file is not None:
+        deadlock_table = load_deadlock_table(deadlock_basis_file)
+    conn.send((None, { "event" : "ready" }))
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            # the service has exited
+            return
+        if job is None:
+            return
+        run_job(conn, job, deadlock_table)
+
+# classes
+
+class Job:
+    def __init__(self, job_id, spec, client, priority = 0, deadline = None):
+        self.id = job_id
+        self.spec = spec
+        self.client = client
+        # job ids are only unique per client
+        self.key = (client, job_id)
+        self.priority = priority
+        self.deadline = deadline
+        self.worker = None
+
+    def expired(self):
+        return self.deadline is not None and time.time() > self.deadline
+
+# workers are spawned rather than forked, so that they don't inherit the
+# event loop or the pipes of other workers, and exit when the service does
+spawn = multiprocessing.get_context("spawn")
+
+class Worker:
+    """warm worker process, w/ at most one job at a time"""
+    def __init__(self, deadlock_basis_file):
+        self.conn, conn = spawn.Pipe()
+        self.process = spawn.Process(
+            target = worker_main, args = (conn, deadlock_basis_file),
+            daemon = True)
+        self.process.start()
+        conn.close()
+        self.ready = False
+        self.job = None
+
+    def stop(self, kill = False):
+        if kill:
+            self.process.terminate()
+        else:
+            try:
+                self.conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        self.process.join(timeout = None if kill else 1)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.conn.close()
+
+class SolverService:
+    """accepts solve requests as json lines, one object per line:
+         { "op" : "solve", "puzzle" : "...", "id" : ..., "priority" : 0,
+           "deadline" : seconds, "solver" : "astar", "heuristic" :
+           "manhattan", "deadlock" : true, "learn" : false,
+           "max_nodes" : 100000, "max_bytes" : null }
+         { "op" : "cancel", "id" : ... }
+         { "op" : "status" }
+       and streams back events (queued, started, progress, result, error,
+       cancelled, expired) tagged w/ the job id. ids are chosen by each
+       client (or assigned if left out), and only refer to the jobs of
+       that client. lower priorities run first. w/ learned_basis_file,
+       deadlock patterns learned by "learn" jobs are merged into that file
+       (results give the number learned)
+    """
+    def __init__(self, workers = 2, max_queued = 1000, max_client_jobs = 100,
+                 deadlock_basis_file = "deadlock_basis.txt",
+                 learned_basis_file = None):
+        self.n_workers = workers
+        self.max_queued = max_queued
+        self.max_client_jobs = max_client_jobs
+        self.deadlock_basis_file = deadlock_basis_file \
+            if deadlock_basis_file and os.path.exists(deadlock_basis_file) \
+            else None
+        self.learned_basis_file = learned_basis_file
+
+        self.queue = []
+        self.jobs = {}
+        self.workers = []
+        self.order = itertools.count()
+        self.ids = itertools.count(1)
+        self.server = None
+
+    # workers
+
+    def start_worker(self):
+        worker = Worker(self.deadlock_basis_file)
+        self.workers.append(worker)
+        asyncio.get_running_loop().add_reader(
+            worker.conn.fileno(), self.on_worker_message, worker)
+        return worker
+
+    def replace_worker(self, worker):
+        if worker not in self.workers:
+            return
+        asyncio.get_running_loop().remove_reader(worker.conn.fileno())
+        self.workers.remove(worker)
+        worker.stop(kill = True)
+        self.start_worker()
+
+    def on_worker_message(self, worker):
+        try:
+            job_id, event = worker.conn.recv()
+        except (EOFError, OSError):
+            # worker died, e.g. out of memory
+            job = worker.job
+            self.replace_worker(worker)
+            if job is not None:
+                self.finish(job, { "event" : "error",
+                                   "message" : "worker exited" })
+            return
+
+        if event["event"] == "ready":
+            worker.ready = True
+        else:
+            job = worker.job
+            if job is None or job.id != job_id:
+                return
+            if "learned" in event:
+                event = dict(event, learned = self.learned(event["learned"]))
+            self.send(job, event)
+            if event["event"] in ("result", "error"):
+                worker.job = None
+                self.finish(job)
+        self.dispatch()
+
+    def dispatch(self):
+        """start queued jobs on idle workers, highest priority first"""
+        idle = [worker for worker in self.workers
+                if worker.ready and worker.job is None]
+        while len(idle) > 0 and len(self.queue) > 0:
+            _, _, _, job = heapq.heappop(self.queue)
+            if self.jobs.get(job.key) is not job:
+                continue
+            if job.expired():
+                self.finish(job, { "event" : "expired" })
+                continue
+            worker = idle.pop()
+            worker.job, job.worker = job, worker
+            spec = dict(job.spec, id = job.id)
+            if job.deadline is not None:
+                spec["time_limit"] = max(0, job.deadline - time.time())
+                asyncio.get_running_loop().call_at(
+                    asyncio.get_running_loop().time() + spec["time_limit"],
+                    self.expire, job)
+            worker.conn.send(spec)
+            self.send(job, { "event" : "started" })
+
+    def expire(self, job):
+        if self.jobs.get(job.key) is job and job.worker is not None:
+            self.stop_job(job, { "event" : "expired" })
+            self.dispatch()
+
+    def learned(self, patterns):
+        """save patterns learned by a job, output: number of patterns"""
+        if self.learned_basis_file is not None and len(patterns) > 0:
+            merge_deadlock_basis(self.learned_basis_file, patterns)
+        return len(patterns)
+
+    # jobs
+
+    def submit(self, request, client):
+        job_id = request.get("id")
+        if job_id is None:
+            # assigned ids skip the ids that the client has chosen itself
+            job_id = next(self.ids)
+            while job_id in client.jobs:
+                job_id = next(self.ids)
+        if not isinstance(job_id, (int, str)):
+            return { "event" : "error", "message" : "invalid job id" }
+        if job_id in client.jobs:
+            return { "id" : job_id, "event" : "error",
+                     "message" : "duplicate job id" }
+        if len(self.queue) >= self.max_queued or \
+           len(client.jobs) >= self.max_client_jobs:
+            return { "id" : job_id, "event" : "error",
+                     "message" : "too many jobs" }
+        if "puzzle" not in request:
+            return { "id" : job_id, "event" : "error",
+                     "message" : "missing puzzle" }
+
+        deadline = request.get("deadline")
+        job = Job(job_id, { key : request[key] for key in
+                            ["puzzle", "solver", "heuristic", "deadlock",
+                             "learn", "max_nodes", "max_bytes"]
+                            if key in request },
+                  client, request.get("priority", 0),
+                  None if deadline is None else time.time() + deadline)
+        self.jobs[job.key] = job
+        client.jobs.add(job_id)
+        heapq.heappush(self.queue, (job.priority, job.deadline or inf,
+                                    next(self.order), job))
+        self.send(job, { "event" : "queued" })
+        self.dispatch()
+        return None
+
+    def stop_job(self, job, event):
+        if job.worker is not None:
+            # the only way to interrupt a running solve is to replace the
+            # worker, which then warms up again in the background
+            worker, job.worker = job.worker, None
+            worker.job = None
+            self.replace_worker(worker)
+        self.finish(job, event)
+
+    def cancel(self, client, job_id):
+        """cancel a job of client, which can't cancel the jobs of others"""
+        job = self.jobs.get((client, job_id)) \
+              if isinstance(job_id, (int, str)) else None
+        if job is None:
+            return False
+        self.stop_job(job, { "event" : "cancelled" })
+        self.dispatch()
+        return True
+
+    def finish(self, job, event = None):
+        if event is not None:
+            self.send(job, event)
+        self.jobs.pop(job.key, None)
+        job.client.jobs.discard(job.id)
+
+    def send(self, job, event):
+        job.client.send(dict(event, id = job.id))
+
+    def status(self):
+        return { "event" : "status",
+                 "queued" : len([job for job in self.jobs.values()
+                                 if job.worker is None]),
+                 "running" : len([w for w in self.workers if w.job]),
+                 "workers" : len(self.workers),
+                 "ready" : len([w for w in self.workers if w.ready]) }
+
+    # clients
+
+    async def handle_client(self, reader, writer):
+        client = Client(writer)
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except (ConnectionError, asyncio.CancelledError):
+                    # client went away, or the service is shutting down
+                    break
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                    op = request.get("op", "solve")
+                except (ValueError, AttributeError):
+                    client.send({ "event" : "error",
+                                  "message" : "invalid request" })
+                    continue
+
+                if op == "solve":
+                    error = self.submit(request, client)
+                    if error is not None:
+                        client.send(error)
+                elif op == "cancel":
+                    if not self.cancel(client, request.get("id")):
+                        client.send({ "id" : request.get("id"),
+                                      "event" : "error",
+                                      "message" : "unknown job id" })
+                elif op == "status":
+                    client.send(self.status())
+                else:
+                    client.send({ "event" : "error",
+                                  "message" : "unknown op " + repr(op) })
+                await writer.drain()
+        finally:
+            # jobs of clients that went away are cancelled
+            for job_id in list(client.jobs):
+                self.cancel(client, job_id)
+            client.closed = True
+            writer.close()
+
+    async def serve(self, socket_path = service_socket, port = None):
+        """serve on a unix socket, or on a loopback tcp port if given"""
+        for _ in range(self.n_workers):
+            self.start_worker()
+        if port is not None:
+            self.server = await asyncio.start_server(
+                self.handle_client, "127.0.0.1", port)
+        else:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            self.server = await asyncio.start_unix_server(
+                self.handle_client, socket_path)
+        loop = asyncio.get_running_loop()
+        for signum in [signal.SIGINT, signal.SIGTERM]:
+            loop.add_signal_handler(signum, self.server.close)
+        try:
+            async with self.server:
+                await self.server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.close()
+            if port is None and os.path.exists(socket_path):
+                os.remove(socket_path)
+
+    def close(self):
+        loop = asyncio.get_running_loop()
+        workers, self.workers = self.workers, []
+        for worker in workers:
+            loop.remove_reader(worker.conn.fileno())
+            worker.stop()
+        self.jobs.clear()
+
+class Client:
+    def __init__(self, writer):
+        self.writer = writer
+        self.jobs = set()
+        self.closed = False
+
+    def send(self, event):
+        if not self.closed:
+            self.writer.write((json.dumps(event) + "\n").encode("utf-8"))
+
+# client side
+
+def connect(socket_path = service_socket, port = None):
+    if port is not None:
+        return socket.create_connection(("127.0.0.1", port))
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.connect(socket_path)
+    return conn
+
+def request_solve(puzzle, socket_path = service_socket, port = None,
+                  **options):
+    """send one puzzle (Sokoban or microban string) to a running service,
+       and yield its events until the job has finished
+    """
+    puzzle = str(puzzle)
+    with connect(socket_path, port) as conn, \
+         conn.makefile(mode = "rw", encoding = "utf-8") as f:
+        f.write(json.dumps(dict(options, op = "solve",
+                                puzzle = puzzle)) + "\n")
+        f.flush()
+        for line in f:
+            event = json.loads(line)
+            yield event
+            if event["event"] in ("result", "error", "cancelled",
+                                  "expired"):
+                return
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "local solving service")
+    parser.add_argument("command", choices = ["serve", "solve"])
+    parser.add_argument("puzzle_file", nargs = "?")
+    parser.add_argument("--socket", default = service_socket)
+    parser.add_argument("--port", type = int, default = None)
+    parser.add_argument("--workers", type = int, default = 2)
+    parser.add_argument("--basis-file", default = "deadlock_basis.txt")
+    parser.add_argument("--learned-basis-file", default = None)
+    parser.add_argument("--solver", default = "astar")
+    parser.add_argument("--heuristic", default = "manhattan")
+    parser.add_argument("--max-nodes", type = int, default = 10 ** 5)
+    parser.add_argument("--max-bytes", type = int, default = None)
+    parser.add_argument("--priority", type = int, default = 0)
+    parser.add_argument("--deadline", type = float, default = None)
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        service = SolverService(args.workers,
+                                deadlock_basis_file = args.basis_file,
+                                learned_basis_file = args.learned_basis_file)
+        asyncio.run(service.serve(args.socket, args.port))
+    else:
+        with open(args.puzzle_file, mode = "r", encoding = "utf-8") as f:
+            puzzle = f.read()
+        options = { "solver" : args.solver, "heuristic" : args.heuristic,
+                    "max_nodes" : args.max_nodes,
+                    "priority" : args.priority }
+        if args.deadline is not None:
+            options["deadline"] = args.deadline
+        if args.max_bytes is not None:
+            options["max_bytes"] = args.max_bytes
+        for event in request_solve(puzzle, args.socket, args.port, **options):
+            print(json.dumps(event), flush = True)
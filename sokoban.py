@@ -1,14 +1,24 @@
 from abc import ABC, abstractmethod
 import copy
 import time
+import hashlib
 import numpy as np
 
 from random import *
-from skimage import measure
 
 from constants import *
 from util import *
 
+measure = lazy_import("skimage.measure")
+
+# functions
+
+def isometry(array, t):
+    """apply one of the 8 rotations / reflections (t = 0 ... 7) of a board"""
+    if t >= 4:
+        array = np.flip(array, 1)
+    return np.rot90(array, t % 4)
+
 # classes
 
 class Action(ABC):
@@ -47,6 +57,7 @@ class KeyboardAction(Action):
                 game.board[game.player + direction + direction] ^= BOX
             else:
                 return
+            game.player += direction
 
 class BoxPushAction(Action):
     def __init__(self, box_position, direction):
@@ -70,10 +81,56 @@ class BoxPushAction(Action):
             # move player to new normalized position
             game.player = game.get_normalized_player_position()
 
+    @property
+    def destination(self):
+        # position of the pushed box after the action
+        return self.box_position + self.direction
+
+    @property
+    def cost(self):
+        # number of box pushes performed by this action
+        return 1
+
+    def expand(self, game):
+        """list that alternates btwn state, action, ... for each single push
+           performed by this action, starting from game (excluding result)
+        """
+        return [game, self]
+
     def __str__(self):
         return "box = " + str(self.box_position) + \
                ", dir = " + str(self.direction)
 
+class MacroPushAction(BoxPushAction):
+    # sequence of box pushes that is treated as a single action
+    def __init__(self, steps):
+        super(MacroPushAction, self).__init__(steps[0].box_position,
+                                              steps[0].direction)
+        self.steps = steps
+
+    def act(self, game):
+        for step in self.steps:
+            step.act(game)
+
+    @property
+    def destination(self):
+        return self.steps[-1].destination
+
+    @property
+    def cost(self):
+        return sum([step.cost for step in self.steps])
+
+    def expand(self, game):
+        history = []
+        for step in self.steps:
+            history += step.expand(game)
+            game = game.copy()
+            step.act(game)
+        return history
+
+    def __str__(self):
+        return "[" + "; ".join(map(str, self.steps)) + "]"
+
 class Position:
     def __init__(self, row, col):
         self.row = int(row)
@@ -242,6 +299,11 @@ class Sokoban:
         return Sokoban(self.board.copy(), self.player.copy(),
                        [goal.copy() for goal in self.goals])
 
+    def box_key(self):
+        """hashable key for walls, boxes, and goals, ignoring the player"""
+        return (self.board.shape, self.board.tobytes(),
+                tuple((goal.row, goal.col) for goal in self.goals))
+
     def solved(self):
         return all([box in self.goals for box in self.board.boxes])
 
@@ -265,16 +327,40 @@ class Sokoban:
         return Position(*position)
 
     def get_push_actions(self):
-        reachable = list(self.get_player_reachable_positions())
+        # set of (row, col) tuples, for constant time membership tests
+        reachable = set(self.get_player_reachable_positions())
         for box_position in self.board.boxes:
             box_position = Position(*box_position)
             for direction in directions.values():
                 if not self.board.in_bounds(box_position + direction) \
                    or self.board[box_position + direction] == SPACE:
-                    if self.board.in_bounds(box_position - direction) \
-                       and box_position - direction in reachable:
+                    player = box_position - direction
+                    if self.board.in_bounds(player) \
+                       and (player.row, player.col) in reachable:
                         yield BoxPushAction(box_position, direction)
 
+    def canonical_form(self):
+        """bytes that are equal for all puzzles that are the same up to
+           rotation / reflection and player position within its region,
+           along w/ the isometry that maps this puzzle onto that form
+        """
+        grid = np.array(self.board, dtype = np.uint8)
+        for goal in self.goals:
+            grid[goal.row, goal.col] |= GOAL
+        if self.player is not None:
+            for position in self.get_player_reachable_positions():
+                grid[position] |= PLAYER
+
+        forms = []
+        for t in range(8):
+            array = isometry(grid, t)
+            forms.append((str(array.shape).encode() + array.tobytes(), t))
+        return min(forms)
+
+    def canonical_hash(self):
+        """hex digest of canonical form, shared by all 8 isometries"""
+        return hashlib.sha1(self.canonical_form()[0]).hexdigest()
+
     def to_str(self, encoding = microban_encoding):
         s = ""
         for r, row in enumerate(self.board):
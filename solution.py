@@ -0,0 +1,192 @@
+# compact LURD move strings for solutions, and fast batch validation
+
+import os
+import argparse
+import multiprocessing
+import numpy as np
+
+from collections import deque
+
+from constants import *
+from corpus import *
+from file import *
+from sokoban import *
+
+# lowercase letters are moves, uppercase letters are pushes
+lurd_chars = { UP : "u", RIGHT : "r", DOWN : "d", LEFT : "l" }
+lurd_directions = { char : d for d, char in lurd_chars.items() }
+direction_index = { directions[d] : d for d in directions }
+
+# classes
+
+class PackedState:
+    """flat, mutable copy of a puzzle for replaying moves quickly. cells are
+       indexed by row * cols + col, and neighbors[i][d] is -1 off the board
+    """
+    def __init__(self, sokoban):
+        board = sokoban.board
+        self.rows, self.cols = board.rows, board.cols
+        self.walls = (np.asarray(board) == WALL).flatten().tolist()
+        self.boxes = ((np.asarray(board) & BOX) != 0).flatten().tolist()
+        self.goals = [goal.row * self.cols + goal.col
+                      for goal in sokoban.goals]
+        self.player = None if sokoban.player is None else \
+                      sokoban.player.row * self.cols + sokoban.player.col
+
+        rows, cols = np.divmod(np.arange(self.rows * self.cols), self.cols)
+        neighbors = []
+        for d in sorted(directions):
+            rows_, cols_ = rows + directions[d][0], cols + directions[d][1]
+            valid = (rows_ >= 0) & (rows_ < self.rows) & \
+                    (cols_ >= 0) & (cols_ < self.cols)
+            neighbors.append(np.where(valid, rows_ * self.cols + cols_, -1))
+        self.neighbors = np.stack(neighbors, axis = 1).tolist()
+
+    def free(self, i):
+        return i >= 0 and not self.walls[i] and not self.boxes[i]
+
+    def move(self, d, push = None):
+        """move player in direction d, pushing a box if one is in the way.
+           if push is given, it must match whether a box is pushed
+           output: true if the move was legal
+        """
+        i = self.neighbors[self.player][d]
+        if i < 0 or self.walls[i]:
+            return False
+        if self.boxes[i]:
+            if push is False:
+                return False
+            # boxes pushed off of the board are removed, as in the game
+            j = self.neighbors[i][d]
+            if j >= 0 and not self.free(j):
+                return False
+            self.boxes[i] = False
+            if j >= 0:
+                self.boxes[j] = True
+        elif push is True:
+            return False
+        self.player = i
+        return True
+
+    def walk(self, target):
+        """shortest list of directions that moves the player to target
+           w/o pushing any box, or None if target can't be reached
+        """
+        prev = { self.player : None }
+        frontier = deque([self.player])
+        while len(frontier) > 0:
+            i = frontier.popleft()
+            if i == target:
+                path = []
+                while prev[i] is not None:
+                    i, d = prev[i]
+                    path.append(d)
+                return path[:: -1]
+            for d, j in enumerate(self.neighbors[i]):
+                if j not in prev and self.free(j):
+                    prev[j] = (i, d)
+                    frontier.append(j)
+        return None
+
+    def solved(self):
+        return sum(self.boxes) == sum([self.boxes[goal]
+                                       for goal in self.goals])
+
+# functions
+
+def solution_pushes(solution):
+    """(box position, direction) of each push, from a list of actions or
+       from a list that alternates btwn state, action, state ...
+    """
+    if len(solution) > 0 and isinstance(solution[0], Sokoban):
+        solution = solution[1 :: 2]
+    return [(action.box_position, direction_index[tuple(action.direction)])
+            for action in solution]
+
+def to_lurd(sokoban, solution):
+    """expand the pushes of a solution into a LURD string, w/ the player
+       taking a shortest walk to the cell behind the box before each push
+    """
+    state = PackedState(sokoban)
+    moves = []
+    for box, d in solution_pushes(solution):
+        box = box[0] * state.cols + box[1]
+        behind = state.neighbors[box][(d + 2) % 4]
+        path = None if behind < 0 else state.walk(behind)
+        if path is None:
+            raise ValueError("Push of box " + str(divmod(box, state.cols)) +
+                             " is not reachable")
+        moves += [lurd_chars[d_] for d_ in path]
+        state.player = behind
+        if not state.move(d, push = True):
+            raise ValueError("Push of box " + str(divmod(box, state.cols)) +
+                             " is not legal")
+        moves.append(lurd_chars[d].upper())
+    return "".join(moves)
+
+def check_lurd(sokoban, moves):
+    """replay a LURD string on sokoban
+       output: None if the moves solve the puzzle, else the reason why not
+    """
+    state = PackedState(sokoban)
+    if state.player is None:
+        return "puzzle has no player"
+    for k, char in enumerate(moves):
+        d = lurd_directions.get(char.lower())
+        if d is None:
+            return "invalid character %r at move %d" % (char, k)
+        if not state.move(d, push = char.isupper()):
+            return "illegal move %r at move %d" % (char, k)
+    if not state.solved():
+        return "puzzle is not solved"
+    return None
+
+def validate_lurd(sokoban, moves):
+    return check_lurd(sokoban, moves) is None
+
+def check_task(task):
+    # puzzles are sent to worker processes in packed form
+    puzzle, moves = task
+    return check_lurd(unpack_puzzle(puzzle, 0), moves)
+
+def validate_many(puzzles, solutions, processes = None, chunksize = 256):
+    """check LURD solutions of many puzzles in parallel
+       output: list w/ None for each valid solution, else the reason
+    """
+    tasks = [(pack_puzzle(sokoban), moves)
+             for sokoban, moves in zip(puzzles, solutions)]
+    with multiprocessing.Pool(processes) as pool:
+        return pool.map(check_task, tasks, chunksize = chunksize)
+
+def validate_index(puzzle_dir = "puzzles/i2a_generated", index_file = None,
+                   processes = None):
+    """check the solutions stored in an index written by generate_bulk
+       output: mapping from { puzzle number : None or reason }
+    """
+    index_file = index_file or puzzle_dir.rstrip("/") + "_index.txt"
+    numbers, solutions = [], []
+    with open(index_file, mode = "r", encoding = "utf-8") as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) > 4 and fields[4] != "-":
+                numbers.append(int(fields[1]))
+                solutions.append(fields[4])
+    puzzles = [parse_puzzle(os.path.join(puzzle_dir, "gen_%d.txt" % n))
+               for n in numbers]
+    return dict(zip(numbers, validate_many(puzzles, solutions, processes)))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description = "validate LURD solutions stored by generate_bulk")
+    parser.add_argument("--puzzle-dir", default = "puzzles/i2a_generated")
+    parser.add_argument("--index-file", default = None)
+    parser.add_argument("--processes", type = int, default = None)
+    args = parser.parse_args()
+
+    results = validate_index(args.puzzle_dir, args.index_file,
+                             args.processes)
+    for n in sorted(results):
+        if results[n] is not None:
+            print("puzzle #" + str(n) + ": " + results[n])
+    print(str(sum([reason is None for reason in results.values()])) + " / " +
+          str(len(results)) + " solutions valid")
@@ -5,53 +5,153 @@ import numpy as np
 
 from math import *
 from random import *
-from scipy import optimize
 
 from constants import *
 from sokoban import *
 from util import *
 
+# only needed by some heuristics, so imported on first use
+optimize = lazy_import("scipy.optimize")
+tensor = lazy_import("tensor")
+
 # functions
 
 def trace_history(prev, sokoban):
-    """retrace steps from goal state to start state"""
+    """retrace steps from goal state to start state,
+       expanding macro pushes into single pushes
+    """
     history = [sokoban]
     while prev[sokoban] is not None:
         sokoban, action = prev[sokoban]
-        history = [sokoban, action] + history
+        history = action.expand(sokoban) + history
     return history
 
+def stack_boards(states):
+    """(N, rows, cols) array of boards and (rows, cols) boolean goal mask,
+       or (None, None) if the states don't all share a shape + goals
+    """
+    if len(states) == 0:
+        return None, None
+    shape = states[0].board.shape
+    goals = [(goal.row, goal.col) for goal in states[0].goals]
+    for state in states[1 :]:
+        if state.board.shape != shape or \
+           [(goal.row, goal.col) for goal in state.goals] != goals:
+            return None, None
+    goal_mask = np.zeros(shape, dtype = bool)
+    if len(goals) > 0:
+        goal_mask[tuple(np.array(goals).T)] = True
+    return np.stack([state.board for state in states]), goal_mask
+
+def state_bytes(sokoban):
+    """approximate bytes of one state kept by a search, including its own
+       copies of the board, player + goals, and the action that reached it
+    """
+    objects = [sokoban, sokoban.board, sokoban.player, sokoban.goals] + \
+              list(sokoban.goals)
+    # attribute values of each object w/ a __dict__ take about 64 bytes
+    size = sum([approx_size(obj) + 64 * hasattr(obj, "__dict__")
+                for obj in objects])
+    # BoxPushAction w/ its own Position, and the (state, action) tuple
+    return size + 200
+
+def expand(sokoban, macro_moves = None):
+    """yield (neighbor, action) pairs, w/ macro pushes if macro_moves given"""
+    if macro_moves is None:
+        return sokoban.neighbors
+    return macro_moves.neighbors(sokoban)
+
 # classes
 
 class Solver(ABC):
+    # why the last search stopped, one of "solved", "exhausted",
+    # "max_nodes", "timeout", or "budget"
+    status = None
+
+    # approximate bytes per entry of the sets, maps + heaps of a search
+    entry_bytes = 100
+
+    # fraction of max_bytes that searches shrink to once over budget
+    low_water = 0.75
+
     @abstractmethod
     def solve(self, sokoban):
         """input: sokoban puzzle
            output: list that alternates btwn state, action, state ...
+           or None, w/ the reason why in self.status
         """
         pass
 
+    def start(self, sokoban, max_nodes = None, max_bytes = None,
+              time_limit = None):
+        """reset limits at the start of a search"""
+        self.status = None
+        self.max_nodes = max_nodes
+        self.max_bytes = max_bytes
+        self.time_limit = time_limit
+        self.start_time = time.time()
+        self.state_bytes = state_bytes(sokoban)
+
+        # states taken out of the visited set to free memory, which still
+        # count towards max_nodes
+        self.dropped = 0
+
+    def memory(self, states, entries):
+        return states * self.state_bytes + entries * self.entry_bytes
+
+    def memory_used(self):
+        """approximate bytes held by the current search"""
+        return self.memory(len(self.prev), len(self.visited) +
+                           len(self.prev) + len(self.frontier))
+
+    def reduce_memory(self):
+        """free memory once over max_bytes, if the search is able to"""
+        pass
+
+    def limit_reached(self, nodes):
+        """output: reason to stop the search (one of "max_nodes", "timeout",
+           or "budget"), or None to continue
+        """
+        if self.max_nodes is not None and \
+           nodes + self.dropped >= self.max_nodes:
+            return "max_nodes"
+        if self.time_limit is not None and \
+           time.time() - self.start_time > self.time_limit:
+            return "timeout"
+        if self.max_bytes is not None and \
+           self.memory_used() > self.max_bytes:
+            self.reduce_memory()
+            if self.memory_used() > self.max_bytes:
+                return "budget"
+        return None
+
 class WFSSolver(Solver):
     # whatever-first search (i.e., uninformed search)
-    def solve(self, sokoban, max_nodes = 10 ** 6, state = None, quiet = True):
+    def solve(self, sokoban, max_nodes = 10 ** 6, state = None, quiet = True,
+              macro_moves = None, max_bytes = None, time_limit = None):
         # first move player to normalized position
         sokoban = sokoban.copy()
         sokoban.player = sokoban.get_normalized_player_position()
         if state is not None:
             seed(state)
+        self.start(sokoban, max_nodes, max_bytes, time_limit)
         
         self.frontier = frontier = self.data_structure([sokoban])
         self.visited = visited = set([sokoban])
         self.prev = prev = { sokoban : None }
         
-        while len(frontier) > 0 and len(visited) < max_nodes:
+        while len(frontier) > 0:
+            self.status = self.limit_reached(len(visited))
+            if self.status is not None:
+                return None
             sokoban = frontier.get()
 
             if sokoban.solved():
                 quiet or print("visited: " + str(len(visited)))
+                self.status = "solved"
                 return trace_history(prev, sokoban)
 
-            neighbors = list(sokoban.neighbors)
+            neighbors = list(expand(sokoban, macro_moves))
             shuffle(neighbors)
             for sokoban_, action in neighbors:
                 if sokoban_ not in visited:
@@ -59,6 +159,7 @@ class WFSSolver(Solver):
                     visited.add(sokoban_)
                     prev[sokoban_] = (sokoban, action)
 
+        self.status = "exhausted"
         return None
 
 class Queue(list):
@@ -86,25 +187,124 @@ class DFSSolver(WFSSolver):
         return Stack(init)
 
 class Heuristic(ABC):
+    # true for heuristics whose value depends on the region of the player,
+    # not just on the boxes
+    depends_on_player = False
+
     def __init__(self):
         self._max_with = []
+        self._cache = None
         
     @abstractmethod
     def _evaluate(self, sokoban):
         pass
 
-    def evaluate(self, sokoban):
-        value = self._evaluate(sokoban)
+    def _evaluate_child(self, sokoban, parent, action):
+        """evaluate state reached by applying action to parent, where parent
+           is known to have a finite heuristic value
+        """
+        return self._evaluate(sokoban)
+
+    def evaluate(self, sokoban, parent = None, action = None):
+        """if parent + action are given, heuristics may evaluate sokoban
+           incrementally, assuming that parent has a finite value
+        """
+        if self._cache is not None:
+            key = self.cache_key(sokoban)
+            value = self._cache.get(key)
+            if value is not None:
+                return value
+
+        if parent is None:
+            value = self._evaluate(sokoban)
+        else:
+            value = self._evaluate_child(sokoban, parent, action)
         if value != inf:
             for heuristic in self._max_with:
-                value = max(value, heuristic.evaluate(sokoban))
+                value = max(value,
+                            heuristic.evaluate(sokoban, parent, action))
+
+        if self._cache is not None:
+            self._cache.put(key, value)
         return value
 
+    def _evaluate_many(self, states, parent, actions):
+        """evaluate a list of states, by default one at a time"""
+        if parent is None:
+            return [self._evaluate(state) for state in states]
+        return [self._evaluate_child(state, parent, action)
+                for state, action in zip(states, actions)]
+
+    def evaluate_many(self, states, parent = None, actions = None):
+        """evaluate a batch of states, e.g. all children of an expansion.
+           if parent + actions are given, states are the results of
+           applying each action to parent
+           output: list of heuristic values
+        """
+        states = list(states)
+        values = [None] * len(states)
+        keys = [None] * len(states)
+        pending = list(range(len(states)))
+        if self._cache is not None:
+            keys = [self.cache_key(state) for state in states]
+            values = [self._cache.get(key) for key in keys]
+            pending = [k for k in pending if values[k] is None]
+
+        states_ = [states[k] for k in pending]
+        actions_ = None if actions is None else [actions[k] for k in pending]
+        computed = list(self._evaluate_many(states_, parent, actions_))
+
+        # only combine w/ other heuristics where the value is still finite
+        finite = [j for j, value in enumerate(computed) if value != inf]
+        for heuristic in self._max_with:
+            if len(finite) == 0:
+                break
+            others = heuristic.evaluate_many(
+                [states_[j] for j in finite], parent,
+                None if actions_ is None else [actions_[j] for j in finite])
+            for j, value in zip(finite, others):
+                computed[j] = max(computed[j], value)
+            finite = [j for j in finite if computed[j] != inf]
+
+        for k, value in zip(pending, computed):
+            values[k] = value
+            if self._cache is not None:
+                self._cache.put(keys[k], value)
+        return values
+
     def max(self, heuristic):
         """combine two heuristics in a way that maintains admissibility"""
         self._max_with.append(heuristic)
         return self
 
+    def player_dependent(self):
+        """whether this heuristic or any it is combined w/ depends on the
+           region of the player
+        """
+        return self.depends_on_player or \
+               any([heuristic.player_dependent()
+                    for heuristic in self._max_with])
+
+    def cache_key(self, sokoban):
+        """key of cached values. most heuristics only depend on boxes, so
+           the player is only part of the key if it has to be
+        """
+        key = sokoban.box_key()
+        if self.player_dependent():
+            key += (tuple(sokoban.get_normalized_player_position()),)
+        return key
+
+    def cache(self, max_entries = 10 ** 5, max_bytes = None):
+        """memoize combined heuristic value for each box configuration,
+           evicting least recently used values beyond the given limits
+        """
+        self._cache = LRUCache(max_entries, max_bytes)
+        return self
+
+    def cache_info(self):
+        """hit / miss statistics of the cache, or None if not enabled"""
+        return None if self._cache is None else self._cache.info()
+
 class NoHeuristic(Heuristic):
     def _evaluate(self, sokoban):
         # a* search becomes djikstra's search when h(x) = 0
@@ -116,6 +316,13 @@ class RemainingBoxesHeuristic(Heuristic):
         return sum([int(box not in sokoban.goals)
                     for box in sokoban.board.boxes])
 
+    def _evaluate_many(self, states, parent, actions):
+        boards, goals = stack_boards(states)
+        if boards is None:
+            return super(RemainingBoxesHeuristic, self) \
+                   ._evaluate_many(states, parent, actions)
+        return ((boards == BOX) & ~goals).sum(axis = (1, 2)).tolist()
+
 class ManhattanDistHeuristic(Heuristic):
     def _evaluate(self, sokoban):
         # use manhattan distance from each box to closest goal as lower bound
@@ -126,6 +333,19 @@ class ManhattanDistHeuristic(Heuristic):
             distance += min_dist
         return distance
 
+    def _evaluate_many(self, states, parent, actions):
+        boards, goals = stack_boards(states)
+        if boards is None or not goals.any():
+            return super(ManhattanDistHeuristic, self) \
+                   ._evaluate_many(states, parent, actions)
+
+        # distance from each cell to closest goal, summed over box cells
+        rows, cols = np.indices(goals.shape)
+        goal_rows, goal_cols = goals.nonzero()
+        distances = (np.abs(rows[..., None] - goal_rows) +
+                     np.abs(cols[..., None] - goal_cols)).min(axis = -1)
+        return ((boards == BOX) * distances).sum(axis = (1, 2)).tolist()
+
 class MinMatchingHeuristic(Heuristic):
     def _evaluate(self, sokoban):
         # solve minimum matching problem using hungarian algorithm
@@ -136,10 +356,36 @@ class MinMatchingHeuristic(Heuristic):
         row_ind, col_ind = optimize.linear_sum_assignment(cost_matrix)
         return cost_matrix[row_ind, col_ind].sum()
 
-class DynamicDeadlockHeuristic(Heuristic):
+class DeadlockHeuristic(Heuristic):
+    # base class of heuristics that look up subboards in a deadlock table
     def __init__(self, deadlock_table = {}):
-        super(DynamicDeadlockHeuristic, self).__init__()
+        super(DeadlockHeuristic, self).__init__()
         self.deadlock_table = deadlock_table
+        self._codes = {}
+        self._generations = {}
+
+    @property
+    def codes(self):
+        # codes of table boards for batched lookups, computed once per entry.
+        # tables that learn new patterns replace their entries w/ packed
+        # sets of a new generation, so only those entries are recomputed
+        generations = { area : getattr(boards, "generation", None)
+                        for area, boards in self.deadlock_table.items() }
+        if generations != self._generations:
+            self._codes = { area : self._codes[area]
+                            if area in self._generations and
+                            self._generations[area] == generations[area]
+                            else table_codes(self.deadlock_table, area)
+                            for area in generations }
+            self._generations = generations
+        return self._codes
+
+class DynamicDeadlockHeuristic(DeadlockHeuristic):
+    def __init__(self, deadlock_table = {}, verify = False):
+        super(DynamicDeadlockHeuristic, self).__init__(deadlock_table)
+
+        # if verify is true, check incremental results against a full scan
+        self.verify = verify
         
     def _evaluate(self, sokoban):
         # heuristic value is inf if deadlock detected, else defaults to 0
@@ -147,22 +393,142 @@ class DynamicDeadlockHeuristic(Heuristic):
             return inf
         return 0
 
-class StaticDeadlockHeuristic(Heuristic):
-    def __init__(self, deadlock_table = {}):
-        super(StaticDeadlockHeuristic, self).__init__()
-        self.deadlock_table = deadlock_table
-        
+    def _evaluate_child(self, sokoban, parent, action):
+        # parent is deadlock-free, so a deadlock in the child must involve
+        # the pushed box, i.e. the subboard must contain its destination
+        destination = action.destination
+        value = 0
+        if sokoban.board.in_bounds(destination) and \
+           deadlock_detected(self.deadlock_table, sokoban, "dynamic",
+                             destination):
+            value = inf
+
+        if self.verify and value != self._evaluate(sokoban):
+            raise AssertionError("incremental deadlock detection differs "
+                                 "from full scan:\n" + str(sokoban))
+        return value
+
+    def _evaluate_many(self, states, parent, actions):
+        # incremental lookups are already cheap, so only batch full scans
+        boards, goals = stack_boards(states)
+        if parent is not None or boards is None:
+            return super(DynamicDeadlockHeuristic, self) \
+                   ._evaluate_many(states, parent, actions)
+        detected = deadlock_detected_many(self.deadlock_table, boards, goals,
+                                          "dynamic", self.codes)
+        return np.where(detected, inf, 0).tolist()
+
+class StaticDeadlockHeuristic(DeadlockHeuristic):
     def _evaluate(self, sokoban):
         # heuristic value is inf if deadlock detected, else defaults to 0
         if deadlock_detected(self.deadlock_table, sokoban, "static"):
             return inf
         return 0
 
+    def _evaluate_many(self, states, parent, actions):
+        boards, goals = stack_boards(states)
+        if boards is None:
+            return super(StaticDeadlockHeuristic, self) \
+                   ._evaluate_many(states, parent, actions)
+        detected = deadlock_detected_many(self.deadlock_table, boards, goals,
+                                          "static", self.codes)
+        return np.where(detected, inf, 0).tolist()
+
+class ModelHeuristic(Heuristic):
+    """heuristic given by a batch model, e.g. a learned network. model is
+       called w/ a (N, C, H, W) uint8 array from tensor.encode_states and
+       returns N values, in batches of at most batch_size states
+    """
+    # models see the player, like any other part of the state
+    depends_on_player = True
+
+    def __init__(self, model, batch_size = 256, shape = None):
+        super(ModelHeuristic, self).__init__()
+        self.model = model
+        self.batch_size = batch_size
+        self.shape = shape
+
+    def _evaluate(self, sokoban):
+        return self._evaluate_many([sokoban], None, None)[0]
+
+    def _evaluate_many(self, states, parent, actions):
+        values = []
+        for k in range(0, len(states), self.batch_size):
+            batch = tensor.encode_states(states[k : k + self.batch_size],
+                                         self.shape)
+            values += np.asarray(self.model(batch), dtype = float).tolist()
+        return values
+
 class GreedyBestFSSolver(Solver):
-    def __init__(self, heuristic = RemainingBoxesHeuristic()):
+    """greedy best-first search. by default, every generated state shares
+       one priority queue, and states are queued w/ the heuristic value of
+       their parent and only evaluated when popped (deferred evaluation).
+       w/ global_frontier = False, only the children of each state are
+       sorted, and pushed onto a stack (i.e. depth-first search)
+    """
+    def __init__(self, heuristic = RemainingBoxesHeuristic(),
+                 global_frontier = True):
         self.heuristic = heuristic
+        self.global_frontier = global_frontier
+
+    def solve(self, sokoban, max_nodes = 10 ** 6, quiet = True,
+              macro_moves = None, max_bytes = None, time_limit = None):
+        self.start(sokoban, max_nodes, max_bytes, time_limit)
+        if self.global_frontier:
+            return self.solve_global(sokoban, quiet, macro_moves)
+        return self.solve_local(sokoban, quiet, macro_moves)
+
+    def solve_global(self, sokoban, quiet = True, macro_moves = None):
+        sokoban = sokoban.copy()
+        sokoban.player = sokoban.get_normalized_player_position()
+
+        self.visited = visited = set([sokoban])
+        self.prev = prev = { sokoban : None }
+        self.frontier = frontier = []
+
+        # children are evaluated incrementally, so the root must be finite
+        h = self.heuristic.evaluate(sokoban)
+        if h == inf:
+            self.status = "exhausted"
+            return None
+        if sokoban.solved():
+            self.status = "solved"
+            return trace_history(prev, sokoban)
+
+        # heap of (priority, order, state, value known) tuples. the most
+        # recently generated state is popped first among equal priorities
+        frontier.append((h, 0, sokoban, True))
+        order = 0
+        while len(frontier) > 0:
+            self.status = self.limit_reached(len(visited))
+            if self.status is not None:
+                return None
+            h, _, sokoban, evaluated = heapq.heappop(frontier)
+            if not evaluated:
+                parent, action = prev[sokoban]
+                h = self.heuristic.evaluate(sokoban, parent, action)
+
+                # prune states that are known to be deadlocked
+                if h == inf:
+                    continue
+
+            for sokoban_, action in expand(sokoban, macro_moves):
+                if sokoban_ in visited:
+                    continue
+                visited.add(sokoban_)
+                prev[sokoban_] = (sokoban, action)
+                if sokoban_.solved():
+                    quiet or print("visited: " + str(len(visited)))
+                    self.status = "solved"
+                    return trace_history(prev, sokoban_)
+                order -= 1
+                heapq.heappush(frontier, (h, order, sokoban_, False))
+
+        # forgotten states may have been the only way to a solution
+        self.status = "budget" if self.dropped > 0 else "exhausted"
+        return None
 
-    def solve(self, sokoban, max_nodes = 10 ** 6, quiet = True):
+    def solve_local(self, sokoban, quiet = True, macro_moves = None):
         sokoban = sokoban.copy()
         sokoban.player = sokoban.get_normalized_player_position()
 
@@ -170,35 +536,81 @@ class GreedyBestFSSolver(Solver):
         self.visited = visited = set(frontier)
         self.prev = prev = { sokoban : None }
 
-        while len(frontier) > 0 and len(visited) < max_nodes:
+        # children are evaluated incrementally, so the root must be finite
+        if self.heuristic.evaluate(sokoban) == inf:
+            self.status = "exhausted"
+            return None
+
+        while len(frontier) > 0:
+            self.status = self.limit_reached(len(visited))
+            if self.status is not None:
+                return None
             sokoban = frontier.pop()
 
             if sokoban.solved():
                 quiet or print("visited: " + str(len(visited)))
+                self.status = "solved"
                 return trace_history(prev, sokoban)
 
-            neighbors = []
-            for sokoban_, action in sokoban.neighbors:
+            children = []
+            for sokoban_, action in expand(sokoban, macro_moves):
                 if sokoban_ not in visited:
-                    neighbors.append(sokoban_)
                     visited.add(sokoban_)
                     prev[sokoban_] = (sokoban, action)
+                    children.append((sokoban_, action))
+
+            # evaluate all children at once, pruning known deadlocks
+            values = self.heuristic.evaluate_many(
+                [sokoban_ for sokoban_, _ in children], sokoban,
+                [action for _, action in children])
+            neighbors = [(h, sokoban_) for h, (sokoban_, _)
+                         in zip(values, children) if h != inf]
 
-            neighbors = list(sorted(neighbors, key = self.heuristic.evaluate,
+            neighbors = list(sorted(neighbors, key = lambda n: n[0],
                                     reverse = True))
-            frontier.extend(neighbors)
+            frontier.extend([sokoban_ for _, sokoban_ in neighbors])
 
+        self.status = "exhausted"
         return None
 
+    def reduce_memory(self):
+        """forget the worst states of the global frontier, which may be
+           found again later from another parent
+        """
+        if not self.global_frontier:
+            return
+        target = self.low_water * self.max_bytes
+        excess = self.memory_used() - target
+        frontier = sorted(self.frontier, key = lambda entry: entry[: 2])
+        removed = 0
+        # the best state is always kept
+        while excess > 0 and len(frontier) > 1:
+            _, _, sokoban, _ = frontier.pop()
+            self.visited.discard(sokoban)
+            self.dropped += 1
+            del self.prev[sokoban]
+            excess -= self.state_bytes + 3 * self.entry_bytes
+            removed += 1
+        if removed > 0:
+            self.frontier[:] = frontier
+            heapq.heapify(self.frontier)
+
 class AStarSolver(Solver):
     def __init__(self, heuristic = NoHeuristic()):
         self.heuristic = heuristic
 
-    def solve(self, sokoban, max_nodes = 10 ** 6, state = None, quiet = True):
+    def solve(self, sokoban, max_nodes = 10 ** 6, state = None, quiet = True,
+              macro_moves = None, max_bytes = None, time_limit = None):
+        """w/ max_bytes, entries of expanded states are dropped from
+           tot_dist_map, and then the worst states of the frontier are
+           forgotten whenever the search runs over budget
+        """
         sokoban = sokoban.copy()
         sokoban.player = sokoban.get_normalized_player_position()
         if state is not None:
             seed(state)
+        self.start(sokoban, max_nodes, max_bytes, time_limit)
+        self.trimmed = False
         
         # total distance from start to goal for each node found so far
         self.tot_dist_map = tot_dist_map = \
@@ -209,6 +621,8 @@ class AStarSolver(Solver):
         
         # heap containing (current dist + estimated dist to goal, sokoban) pairs
         self.frontier = frontier = [(tot_dist_map[sokoban], sokoban)]
+        if tot_dist_map[sokoban] == inf:
+            frontier.clear()
 
         # set of visited sokoban problem instances
         self.visited = visited = set([sokoban])
@@ -216,34 +630,264 @@ class AStarSolver(Solver):
         # mapping from puzzle instance to state + action that produced it
         self.prev = prev = { sokoban : None }
         
-        while len(frontier) > 0 and len(visited) < max_nodes:
+        while len(frontier) > 0:
+            self.status = self.limit_reached(len(visited))
+            if self.status is not None:
+                return None
+
             # skip if node is outdated
             tot_dist, sokoban = heapq.heappop(frontier)
-            if tot_dist != tot_dist_map[sokoban]:
+            if tot_dist != tot_dist_map.get(sokoban):
                 continue
+            if self.trimmed:
+                del tot_dist_map[sokoban]
 
             # check if goal has been reached
             if sokoban.solved():
                 quiet or print("visited: " + str(len(visited)))
+                self.status = "solved"
                 return trace_history(prev, sokoban)
             visited.add(sokoban)
 
-            neighbors = list(sokoban.neighbors)
+            neighbors = list(expand(sokoban, macro_moves))
             shuffle(neighbors)
             cur_dist = cur_dist_map[sokoban]
-            for sokoban_, action in neighbors:
-                if sokoban_ in visited:
-                    continue
 
-                # skip if solution is not as good as the one already found
-                dist = cur_dist + 1
+            # skip if solution is not as good as the one already found
+            neighbors = [(sokoban_, action) for sokoban_, action in neighbors
+                         if sokoban_ not in visited and cur_dist +
+                         action.cost < cur_dist_map.get(sokoban_, inf)]
+            values = self.heuristic.evaluate_many(
+                [sokoban_ for sokoban_, _ in neighbors], sokoban,
+                [action for _, action in neighbors])
+            for (sokoban_, action), h in zip(neighbors, values):
+                dist = cur_dist + action.cost
                 if not dist < cur_dist_map.get(sokoban_, inf):
                     continue
 
+                # prune states that are known to be deadlocked
+                if h == inf:
+                    continue
+
                 cur_dist_map[sokoban_] = dist
-                tot_dist_map[sokoban_] = dist + \
-                                         self.heuristic.evaluate(sokoban_)
+                tot_dist_map[sokoban_] = dist + h
                 heapq.heappush(frontier, (tot_dist_map[sokoban_], sokoban_))
                 prev[sokoban_] = (sokoban, action)
 
+        self.status = "exhausted"
         return None
+
+    def memory_used(self):
+        return self.memory(len(self.prev), len(self.visited) +
+                           len(self.prev) + len(self.cur_dist_map) +
+                           len(self.tot_dist_map) + len(self.frontier))
+
+    def reduce_memory(self):
+        """first drop tot_dist_map entries of expanded states + outdated
+           frontier entries. if still over budget, forget the worst leaves
+           of the frontier (as in SMA*), and reopen their parents w/ the
+           least value of their forgotten children, so that the children
+           can be generated again if the search comes back to them
+        """
+        tot_dist_map, cur_dist_map = self.tot_dist_map, self.cur_dist_map
+        prev, visited, frontier = self.prev, self.visited, self.frontier
+        if not self.trimmed:
+            self.trimmed = True
+            for sokoban in visited:
+                tot_dist_map.pop(sokoban, None)
+        frontier[:] = [(tot_dist, sokoban) for tot_dist, sokoban in frontier
+                       if tot_dist_map.get(sokoban) == tot_dist]
+        heapq.heapify(frontier)
+        excess = self.memory_used() - self.low_water * self.max_bytes
+        if excess <= 0:
+            return
+
+        # states that other states were reached from can't be forgotten,
+        # and the best state is always kept
+        parents = set([entry[0] for entry in prev.values()
+                       if entry is not None])
+        leaves = sorted([(tot_dist, sokoban) for tot_dist, sokoban
+                         in frontier[1 :] if sokoban not in parents],
+                        key = lambda entry: entry[0])
+        backed_up = {}
+        forgotten = set()
+        while excess > 0 and len(leaves) > 0:
+            tot_dist, sokoban = leaves.pop()
+            parent, _ = prev.pop(sokoban)
+            del tot_dist_map[sokoban], cur_dist_map[sokoban]
+            forgotten.add(sokoban)
+            backed_up[parent] = min(backed_up.get(parent, inf), tot_dist)
+            excess -= self.state_bytes + 4 * self.entry_bytes
+
+        frontier[:] = [(tot_dist, sokoban) for tot_dist, sokoban in frontier
+                       if sokoban not in forgotten]
+        for parent, tot_dist in backed_up.items():
+            if tot_dist_map.get(parent, inf) <= tot_dist:
+                continue
+            if parent in visited:
+                visited.discard(parent)
+                self.dropped += 1
+            tot_dist_map[parent] = tot_dist
+            frontier.append((tot_dist, parent))
+        heapq.heapify(frontier)
+
+class ARAStarSolver(Solver):
+    """anytime repairing A* (ARA*). finds a first solution quickly w/ a
+       large heuristic weight, then lowers the weight and continues from
+       the states found so far. if the heuristic is admissible, each
+       solution is at most (bound) times longer than an optimal one
+    """
+    def __init__(self, heuristic = NoHeuristic(), weight = 5.0,
+                 weight_step = 1.0):
+        self.heuristic = heuristic
+        self.weight = weight
+        self.weight_step = weight_step
+
+    def solve(self, sokoban, max_nodes = 10 ** 6, time_limit = None,
+              state = None, quiet = True, macro_moves = None):
+        """best solution found within max_nodes expansions + time_limit
+           seconds, or None. its bound is stored in self.bound. the status
+           is "solved" once the solution is known to be optimal, and
+           otherwise gives the limit that stopped the search
+        """
+        solution = None
+        for solution, _ in self.solutions(sokoban, max_nodes, time_limit,
+                                          state, quiet, macro_moves):
+            pass
+        return solution
+
+    def solutions(self, sokoban, max_nodes = 10 ** 6, time_limit = None,
+                  state = None, quiet = True, macro_moves = None):
+        """yield (solution, bound) each time a solution or its bound improves,
+           so that callers can stop whenever a solution is good enough
+        """
+        sokoban = sokoban.copy()
+        sokoban.player = sokoban.get_normalized_player_position()
+        if state is not None:
+            seed(state)
+        self.start(sokoban, max_nodes, time_limit = time_limit)
+        start_time = self.start_time
+
+        # (pushes, bound, nodes expanded, seconds) of each improvement
+        self.improvements = improvements = []
+        self.bound = None
+
+        self.h_map = h_map = { sokoban : self.heuristic.evaluate(sokoban) }
+        self.cur_dist_map = cur_dist_map = { sokoban : 0 }
+        self.prev = prev = { sokoban : None }
+        self.visited = visited = set()
+        self.frontier = frontier = []
+        if h_map[sokoban] == inf:
+            self.status = "exhausted"
+            return
+
+        weight = self.weight
+        def key(sokoban):
+            return cur_dist_map[sokoban] + weight * h_map[sokoban]
+
+        # open states are in key_map + frontier, while states that improve
+        # after being expanded in this iteration wait in inconsistent
+        self.key_map = key_map = { sokoban : key(sokoban) }
+        frontier.append((key_map[sokoban], sokoban))
+        inconsistent = set()
+        goal = sokoban if sokoban.solved() else None
+        expanded = 0
+
+        while True:
+            # expand states until no open state can lead to a better goal
+            while len(frontier) > 0:
+                tot_dist, sokoban = frontier[0]
+                if key_map.get(sokoban) != tot_dist:
+                    heapq.heappop(frontier)
+                    continue
+                if goal is not None and cur_dist_map[goal] <= tot_dist:
+                    break
+                self.status = self.limit_reached(expanded)
+                if self.status is not None:
+                    return
+
+                heapq.heappop(frontier)
+                del key_map[sokoban]
+                visited.add(sokoban)
+                expanded += 1
+                if sokoban.solved():
+                    continue
+
+                neighbors = list(expand(sokoban, macro_moves))
+                shuffle(neighbors)
+                cur_dist = cur_dist_map[sokoban]
+                neighbors = [(sokoban_, action)
+                             for sokoban_, action in neighbors
+                             if cur_dist + action.cost <
+                             cur_dist_map.get(sokoban_, inf)]
+
+                # heuristic values don't depend on the weight, so each state
+                # is only evaluated once
+                new = [(sokoban_, action) for sokoban_, action in neighbors
+                       if sokoban_ not in h_map]
+                values = self.heuristic.evaluate_many(
+                    [sokoban_ for sokoban_, _ in new], sokoban,
+                    [action for _, action in new])
+                for (sokoban_, _), h in zip(new, values):
+                    h_map[sokoban_] = h
+
+                for sokoban_, action in neighbors:
+                    # prune states that are known to be deadlocked
+                    if h_map[sokoban_] == inf:
+                        continue
+                    cur_dist_map[sokoban_] = cur_dist + action.cost
+                    prev[sokoban_] = (sokoban, action)
+                    if sokoban_.solved() and (goal is None or
+                                              cur_dist_map[sokoban_] <
+                                              cur_dist_map[goal]):
+                        goal = sokoban_
+                    if sokoban_ in visited:
+                        inconsistent.add(sokoban_)
+                    else:
+                        key_map[sokoban_] = key(sokoban_)
+                        heapq.heappush(frontier,
+                                       (key_map[sokoban_], sokoban_))
+
+            if goal is None:
+                self.status = "exhausted"
+                return
+
+            # suboptimality bound, from the least f = g + h of any state
+            # that could still lead to a shorter solution
+            pending = set(key_map) | inconsistent
+            if len(pending) == 0:
+                bound = 1.0
+            else:
+                least = min([cur_dist_map[sokoban_] + h_map[sokoban_]
+                             for sokoban_ in pending])
+                if cur_dist_map[goal] <= least:
+                    # e.g. the start state is already solved
+                    bound = 1.0
+                elif least <= 0:
+                    bound = weight
+                else:
+                    bound = max(1.0, min(weight, cur_dist_map[goal] / least))
+            if len(improvements) == 0 or bound < self.bound or \
+               cur_dist_map[goal] < improvements[-1][0]:
+                self.bound = bound
+                improvements.append((cur_dist_map[goal], bound, expanded,
+                                     time.time() - start_time))
+                quiet or print("pushes: " + str(cur_dist_map[goal]) +
+                               ", bound: " + str(bound) +
+                               ", expanded: " + str(expanded))
+                yield trace_history(prev, goal), bound
+            if bound <= 1.0:
+                self.status = "solved"
+                return
+
+            # lower the weight, and reopen all states w/ updated keys
+            weight = max(1.0, weight - self.weight_step)
+            for sokoban_ in inconsistent:
+                key_map[sokoban_] = None
+            for sokoban_ in key_map:
+                key_map[sokoban_] = key(sokoban_)
+            frontier[:] = [(key_map[sokoban_], sokoban_)
+                           for sokoban_ in key_map]
+            heapq.heapify(frontier)
+            visited.clear()
+            inconsistent.clear()
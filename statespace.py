@@ -0,0 +1,268 @@
+# exact distances of every state of small puzzles, cached on disk
+
+import os
+import json
+import hashlib
+import itertools
+import numpy as np
+
+from math import *
+from random import *
+
+from constants import *
+from detector import *
+from pattern_db import binomials, placement_rank, UNREACHABLE
+from sokoban import *
+from solver import *
+from util import *
+
+# bump whenever the layout or the contents of a table change
+STATE_SPACE_VERSION = 2
+
+statespace_cache_dir = ".statespace_cache"
+
+# functions
+
+def unrank_placement(rank, k, table):
+    """sorted tuple of k cells w/ the given placement_rank"""
+    cells = []
+    for j in range(k, 0, -1):
+        # largest cell c w/ (c choose j) <= rank
+        c = int(np.searchsorted(table[:, j], rank, side = "right")) - 1
+        cells.append(c)
+        rank -= table[c, j]
+    return tuple(cells[:: -1])
+
+def widen(distances):
+    """copy of a distance table w/ a larger dtype, where unreachable
+       states are still marked w/ the largest value of the dtype
+    """
+    dtype = np.uint16 if distances.dtype == np.uint8 else np.uint32
+    wide = distances.astype(dtype)
+    wide[distances == np.iinfo(distances.dtype).max] = np.iinfo(dtype).max
+    return wide
+
+def label_regions(neighbors, occupied):
+    """least cell of the region of each free cell, where cells are floor
+       indices (so the least cell is the top-left one), or -1 if occupied
+    """
+    labels = [-1] * len(neighbors)
+    for i in range(len(neighbors)):
+        if labels[i] >= 0 or i in occupied:
+            continue
+        labels[i] = i
+        frontier = [i]
+        while len(frontier) > 0:
+            j = frontier.pop()
+            for j_ in neighbors[j]:
+                if j_ >= 0 and labels[j_] < 0 and j_ not in occupied:
+                    labels[j_] = i
+                    frontier.append(j_)
+    return labels
+
+def build_distance_table(neighbors, goals, n_boxes, max_cache = 2 ** 16):
+    """exact number of pushes to solve each state, found by breadth-first
+       search over pulls from every solved state (retrograde analysis)
+       input: neighbors[i][d] of each floor cell i (-1 if not floor),
+              goals as floor cells, and number of boxes
+       output: uint8 array indexed by placement_rank(boxes) * len(neighbors)
+               + least cell of the player's region, widened if distances
+               don't fit. the largest value of the dtype (UNREACHABLE for
+               uint8) for states that can't be solved or that don't exist
+    """
+    n, k = len(neighbors), n_boxes
+    table = binomials(n, k)
+    distances = np.full(table[n, k] * n, UNREACHABLE, dtype = np.uint8)
+
+    # regions of each placement of boxes, shared by its states
+    regions = {}
+    def regions_of(boxes):
+        labels = regions.get(boxes)
+        if labels is None:
+            if len(regions) >= max_cache:
+                regions.clear()
+            labels = regions[boxes] = label_regions(neighbors, set(boxes))
+        return labels
+
+    # solved states, w/ the player in any region
+    frontier = []
+    for boxes in itertools.combinations(sorted(goals), k):
+        rank = placement_rank(boxes, table) * n
+        for player in set(regions_of(boxes)) - set([-1]):
+            distances[rank + player] = 0
+            frontier.append((boxes, player))
+
+    distance = 0
+    unreachable = UNREACHABLE
+    while len(frontier) > 0:
+        distance += 1
+        if distance == unreachable:
+            distances = widen(distances)
+            unreachable = np.iinfo(distances.dtype).max
+        frontier_ = []
+        for boxes, player in frontier:
+            labels = regions_of(boxes)
+            for n_box, box in enumerate(boxes):
+                for d in range(4):
+                    # box was pushed in direction d from box_, by a player
+                    # standing at player_ (i.e. pulled in reverse)
+                    box_ = neighbors[box][(d + 2) % 4]
+                    if box_ < 0 or labels[box_] != player:
+                        continue
+                    player_ = neighbors[box_][(d + 2) % 4]
+                    if player_ < 0 or labels[player_] < 0:
+                        continue
+                    boxes_ = tuple(sorted(boxes[: n_box] + (box_,) +
+                                          boxes[n_box + 1 :]))
+                    index = placement_rank(boxes_, table) * n + \
+                            regions_of(boxes_)[player_]
+                    if distances[index] == unreachable:
+                        distances[index] = distance
+                        frontier_.append((boxes_, regions_of(boxes_)[player_]))
+        frontier = frontier_
+    return distances
+
+def state_space_key(level, n_boxes):
+    """hash of walls, goals, and number of boxes"""
+    digest = hashlib.sha1()
+    digest.update(json.dumps({ "version" : STATE_SPACE_VERSION,
+                               "shape" : [level.rows, level.cols],
+                               "goals" : sorted(level.goals),
+                               "boxes" : n_boxes }).encode("utf-8"))
+    digest.update(bytes(level.walls))
+    return digest.hexdigest()
+
+# classes
+
+class StateSpace:
+    """every state of one puzzle w/ a given number of boxes, w/ a perfect
+       hash index per (boxes, player region) state and the exact distance
+       to a solved state. boxes pushed off of the board are not modeled,
+       so rooms should be enclosed by walls
+    """
+    def __init__(self, sokoban, cache_dir = statespace_cache_dir,
+                 max_states = 10 ** 8):
+        level = get_level(sokoban)
+        self.level = level
+        self.n_boxes = len(list(sokoban.board.boxes))
+        self.floor = [i for i in range(level.rows * level.cols)
+                      if not level.walls[i]]
+        self.index = np.full(level.rows * level.cols, -1, dtype = np.int64)
+        self.index[self.floor] = np.arange(len(self.floor))
+        self.neighbors = [[-1 if j is None else int(self.index[j])
+                           for j in level.neighbors[i]] for i in self.floor]
+        self.binomials = binomials(len(self.floor), self.n_boxes)
+        self.size = int(self.binomials[len(self.floor), self.n_boxes]) * \
+                    len(self.floor)
+        if self.size > max_states:
+            raise ValueError("State space of " + str(self.size) +
+                             " states is too large")
+
+        path = None if cache_dir is None else os.path.join(
+            cache_dir, state_space_key(level, self.n_boxes) + ".npy")
+        if path is not None and os.path.exists(path):
+            self.distances = np.load(path)
+        else:
+            goals = [int(self.index[goal]) for goal in level.goals]
+            self.distances = build_distance_table(self.neighbors, goals,
+                                                  self.n_boxes)
+            if path is not None:
+                os.makedirs(cache_dir, exist_ok = True)
+                with open(path + ".tmp", mode = "wb") as f:
+                    np.save(f, self.distances)
+                os.replace(path + ".tmp", path)
+        self.unreachable = np.iinfo(self.distances.dtype).max
+
+    def state_index(self, sokoban):
+        """index of a state of this puzzle, or None if it has a different
+           number of boxes or a box off the floor
+        """
+        boxes = self.index[[box[0] * self.level.cols + box[1]
+                            for box in sokoban.board.boxes]]
+        if len(boxes) != self.n_boxes or (boxes < 0).any():
+            return None
+        occupied = set(boxes.tolist())
+        player = int(self.index[sokoban.player.row * self.level.cols +
+                                sokoban.player.col])
+        region = label_regions(self.neighbors, occupied)[player]
+        return int(placement_rank(np.sort(boxes), self.binomials)) * \
+               len(self.floor) + region
+
+    def distance(self, sokoban):
+        """least number of pushes to solve sokoban, or inf if it can't be"""
+        index = self.state_index(sokoban)
+        if index is None or self.distances[index] == self.unreachable:
+            return inf
+        return int(self.distances[index])
+
+    def decode(self, index):
+        """(box cells, player cell) of a state index, as board cells"""
+        rank, player = divmod(int(index), len(self.floor))
+        boxes = unrank_placement(rank, self.n_boxes, self.binomials)
+        return [self.floor[box] for box in boxes], self.floor[player]
+
+    def valid(self, index):
+        """whether an index belongs to a state, i.e. the player is not on
+           a box, and is the least cell of its region
+        """
+        rank, player = divmod(int(index), len(self.floor))
+        boxes = unrank_placement(rank, self.n_boxes, self.binomials)
+        return label_regions(self.neighbors, set(boxes))[player] == player
+
+class StateSpaceHeuristic(Heuristic):
+    """exact number of pushes left, looked up in the state space of the
+       puzzle (built once per puzzle, and cached on disk). inf if the
+       state can't be solved
+    """
+    depends_on_player = True
+
+    def __init__(self, cache_dir = statespace_cache_dir,
+                 max_states = 10 ** 8):
+        super(StateSpaceHeuristic, self).__init__()
+        self.cache_dir = cache_dir
+        self.max_states = max_states
+        self.spaces = LRUCache(max_entries = 16)
+
+    def space(self, sokoban):
+        n_boxes = len(list(sokoban.board.boxes))
+        level = get_level(sokoban)
+        space = self.spaces.get((id(level), n_boxes))
+        if space is None or space.level is not level:
+            space = StateSpace(sokoban, self.cache_dir, self.max_states)
+            self.spaces.put((id(level), n_boxes), space)
+        return space
+
+    def _evaluate(self, sokoban):
+        return self.space(sokoban).distance(sokoban)
+
+class StateSpaceSolver(Solver):
+    """optimal solutions w/o search, by always pushing to a state that is
+       one push closer to being solved. ties are broken at random
+    """
+    def __init__(self, cache_dir = statespace_cache_dir,
+                 max_states = 10 ** 8):
+        self.heuristic = StateSpaceHeuristic(cache_dir, max_states)
+
+    def solve(self, sokoban, state = None, quiet = True, **kwargs):
+        sokoban = sokoban.copy()
+        sokoban.player = sokoban.get_normalized_player_position()
+        if state is not None:
+            seed(state)
+        self.prev = prev = { sokoban : None }
+        self.visited = visited = set([sokoban])
+
+        distance = self.heuristic.evaluate(sokoban)
+        if distance == inf:
+            self.status = "exhausted"
+            return None
+        while distance > 0:
+            neighbors = [(sokoban_, action) for sokoban_, action
+                         in sokoban.neighbors
+                         if self.heuristic.evaluate(sokoban_) == distance - 1]
+            sokoban_, action = choice(neighbors)
+            prev[sokoban_] = (sokoban, action)
+            visited.add(sokoban_)
+            sokoban, distance = sokoban_, distance - 1
+        quiet or print("pushes: " + str(len(visited) - 1))
+        self.status = "solved"
+        return trace_history(prev, sokoban)
@@ -0,0 +1,157 @@
+# compiled deadlock tables, cached on disk as binary artifacts
+
+import os
+import json
+import hashlib
+import argparse
+import itertools
+import numpy as np
+
+from constants import *
+from file import *
+from sokoban import *
+from util import *
+
+# bump whenever the compiled format or the expansion of a basis changes
+TABLE_VERSION = 1
+
+deadlock_cache_dir = ".deadlock_cache"
+
+# each packed set gets a new generation, so that heuristics can tell when
+# an entry of a table has been replaced (unlike ids, these aren't reused)
+generations = itertools.count()
+
+# classes
+
+class PackedBoardSet:
+    """immutable set of boards of one shape, stored as sorted codes of
+       Board.encode. supports the set operations used on deadlock tables
+    """
+    def __init__(self, codes, shape):
+        self.codes = np.unique(np.asarray(codes, dtype = np.int64))
+        self.shape = tuple(shape)
+        self.generation = next(generations)
+
+    def union(self, boards):
+        if type(boards) is PackedBoardSet and boards.shape == self.shape:
+            return PackedBoardSet(np.concatenate([self.codes, boards.codes]),
+                                  self.shape)
+        return set(self).union(boards)
+
+    def __contains__(self, board):
+        if tuple(board.shape) != self.shape or len(self.codes) == 0:
+            return False
+        code = encode_boards(np.asarray(board))
+        index = min(np.searchsorted(self.codes, code), len(self.codes) - 1)
+        return self.codes[index] == code
+
+    def __iter__(self):
+        # decode base-3 digits of every code at once
+        n = self.shape[0] * self.shape[1]
+        digits = (self.codes[:, None] // 3 ** np.arange(n)) % 3
+        objs = np.array([SPACE, WALL, BOX], dtype = np.uint8)[digits]
+        for array in objs.reshape((-1,) + self.shape):
+            yield Board.from_array(array)
+
+    def __len__(self):
+        return len(self.codes)
+
+# functions
+
+def expand_basis_board(board):
+    """codes of all boards made by filling the spaces of each isometric
+       variant of board w/ spaces, walls, and boxes, grouped by shape
+    """
+    codes = {}
+    for board_ in board.isometric_boards:
+        board_ = np.asarray(board_)
+        spaces = (board_.flatten() == SPACE).nonzero()[0]
+        base = encode_boards(board_)
+
+        # each space contributes digit 0, 1, 2 (space, wall, box)
+        fills = np.arange(3 ** len(spaces), dtype = np.int64)
+        digits = (fills[:, None] // 3 ** np.arange(len(spaces))) % 3
+        fill_codes = base + digits @ (3 ** spaces.astype(np.int64))
+        codes.setdefault(board_.shape, []).append(fill_codes)
+    return { shape : np.concatenate(codes[shape]) for shape in codes }
+
+def compile_deadlock_table(deadlock_basis, max_area = None):
+    """expand a basis into codes of every matching board, keyed by the
+       actual shape of the boards, so that each rotation of a pattern is
+       looked up w/ subboards of its own shape
+       output: mapping from { shape : sorted array of codes }
+    """
+    codes = {}
+    for board in deadlock_basis:
+        if max_area is not None and \
+           (board.rows > max_area[0] or board.cols > max_area[1]):
+            continue
+        for shape, codes_ in expand_basis_board(board).items():
+            codes.setdefault(shape, []).append(codes_)
+    return { shape : np.unique(np.concatenate(codes[shape]))
+             for shape in codes }
+
+def add_deadlock_patterns(deadlock_table, patterns):
+    """add basis boards to a loaded deadlock table in place, so that every
+       heuristic using the table sees them. entries of a shape are
+       replaced by new PackedBoardSets (of a new generation), rather than
+       changed
+    """
+    for board in patterns:
+        for shape, codes in expand_basis_board(board).items():
+            # also packs sets of boards, as built by
+            # gen_deadlock_table_from_basis
+            codes_ = [] if shape not in deadlock_table else \
+                     [table_codes(deadlock_table, shape)]
+            deadlock_table[shape] = PackedBoardSet(
+                np.concatenate(codes_ + [codes]), shape)
+    return deadlock_table
+
+def artifact_key(basis_file, max_area = None):
+    """content hash of the basis file + settings used to compile it"""
+    digest = hashlib.sha256()
+    with open(basis_file, mode = "rb") as f:
+        digest.update(f.read())
+    digest.update(json.dumps({ "version" : TABLE_VERSION,
+                               "max_area" : max_area }).encode("utf-8"))
+    return digest.hexdigest()[: 16]
+
+def build_deadlock_table(basis_file, cache_dir = deadlock_cache_dir,
+                         max_area = None):
+    """compile a basis file into an artifact, unless it is up to date
+       output: path of the artifact
+    """
+    name = os.path.splitext(os.path.basename(basis_file))[0]
+    artifact = os.path.join(cache_dir, "%s_%s.npz" % (
+        name, artifact_key(basis_file, max_area)))
+    if os.path.exists(artifact):
+        return artifact
+
+    codes = compile_deadlock_table(parse_deadlock_table(basis_file), max_area)
+    os.makedirs(cache_dir, exist_ok = True)
+    with open(artifact + ".tmp", mode = "wb") as f:
+        np.savez(f, **{ "%d_%d" % shape : codes[shape] for shape in codes })
+    os.replace(artifact + ".tmp", artifact)
+    return artifact
+
+def load_deadlock_table(basis_file, cache_dir = deadlock_cache_dir,
+                        max_area = None):
+    """load the deadlock table generated from a basis file, compiling it
+       first only if the basis or settings have changed
+       output: mapping from { area : PackedBoardSet }
+    """
+    artifact = build_deadlock_table(basis_file, cache_dir, max_area)
+    with np.load(artifact) as arrays:
+        return { tuple(map(int, key.split("_"))) :
+                 PackedBoardSet(arrays[key], tuple(map(int, key.split("_"))))
+                 for key in arrays.files }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description = "compile a deadlock basis into a cached table")
+    parser.add_argument("basis_file")
+    parser.add_argument("--cache-dir", default = deadlock_cache_dir)
+    parser.add_argument("--max-area", type = int, nargs = 2, default = None)
+    args = parser.parse_args()
+    print(build_deadlock_table(args.basis_file, args.cache_dir,
+                               args.max_area))
@@ -0,0 +1,123 @@
+# batched tensor encoding of sokoban states
+
+import itertools
+import numpy as np
+
+from constants import *
+from sokoban import *
+from util import *
+
+ndimage = lazy_import("scipy.ndimage")
+
+# channels of encoded states, in order
+CHANNELS = ["wall", "box", "goal", "player", "reachable"]
+
+# in-plane 4-connectivity, so that flood fills don't cross between states
+connectivity = np.zeros((3, 3, 3), dtype = bool)
+connectivity[1] = [[0, 1, 0], [1, 1, 1], [0, 1, 0]]
+
+# functions
+
+def encode_grid(sokoban):
+    """single uint8 array w/ walls, boxes, goals, and player bits"""
+    grid = np.array(sokoban.board, dtype = np.uint8)
+    for goal in sokoban.goals:
+        grid[goal.row, goal.col] |= GOAL
+    if sokoban.player is not None:
+        grid[tuple(sokoban.player)] |= PLAYER
+    return grid
+
+def stack_grids(states, shape = None):
+    """zero-padded (N, H, W) array of grids, and (N, 2) array of shapes"""
+    states = list(states)
+    shapes = np.array([state.board.shape for state in states],
+                      dtype = np.int32).reshape(-1, 2)
+    if shape is None:
+        shape = tuple(shapes.max(axis = 0)) if len(states) > 0 else (0, 0)
+    grids = np.zeros((len(states),) + tuple(shape), dtype = np.uint8)
+    goals = []
+    players = []
+    for n, state in enumerate(states):
+        grids[n, : state.board.rows, : state.board.cols] = state.board
+        goals += [(n, goal.row, goal.col) for goal in state.goals]
+        if state.player is not None:
+            players.append((n, state.player.row, state.player.col))
+
+    # set goal + player bits for the whole batch at once
+    if len(goals) > 0:
+        grids[tuple(np.array(goals).T)] |= GOAL
+    if len(players) > 0:
+        grids[tuple(np.array(players).T)] |= PLAYER
+    return grids, shapes
+
+def encode_grids(grids, shapes = None, out = None):
+    """input: grids: (N, H, W) uint8 array of grids, zero-padded
+              shapes: (N, 2) array of unpadded shapes, or None if unpadded
+              out: optional preallocated (>= N, C, H, W) uint8 array
+       output: (N, C, H, W) uint8 array w/ channels in order of CHANNELS
+    """
+    n, rows, cols = grids.shape
+    if out is None:
+        out = np.empty((n, len(CHANNELS), rows, cols), dtype = np.uint8)
+    out = out[: n]
+
+    # cells of the padding are neither walls nor reachable
+    valid = np.ones(grids.shape, dtype = bool)
+    if shapes is not None:
+        valid = (np.arange(rows)[None, :, None] < shapes[:, 0, None, None]) & \
+                (np.arange(cols)[None, None, :] < shapes[:, 1, None, None])
+
+    np.not_equal(grids & WALL, 0, out = out[:, 0])
+    np.not_equal(grids & BOX, 0, out = out[:, 1])
+    np.not_equal(grids & GOAL, 0, out = out[:, 2])
+    np.not_equal(grids & PLAYER, 0, out = out[:, 3])
+
+    # flood fill of every state at once, then keep player's component
+    free = valid & ((grids & (WALL | BOX)) == 0)
+    labels, _ = ndimage.label(free, structure = connectivity)
+    player_labels = np.zeros(n, dtype = labels.dtype)
+    index, r, c = (grids & PLAYER).nonzero()
+    player_labels[index] = labels[index, r, c]
+    np.equal(labels, player_labels[:, None, None], out = out[:, 4])
+    out[:, 4] &= (player_labels != 0)[:, None, None]
+    return out
+
+def encode_states(states, shape = None, out = None):
+    """encode a list of Sokoban objects as a (N, C, H, W) uint8 array,
+       zero-padded to shape (H, W) or to the largest board in states
+    """
+    grids, shapes = stack_grids(states, shape)
+    return encode_grids(grids, shapes, out)
+
+def iter_batches(states, batch_size = 256, shape = None):
+    """stream (batch_size, C, H, W) arrays from any iterable of states,
+       e.g. the visited set of a solver. if shape is given, one output
+       buffer is reused, so each batch is only valid until the next one
+    """
+    states = iter(states)
+    out = None
+    if shape is not None:
+        out = np.empty((batch_size, len(CHANNELS)) + tuple(shape),
+                       dtype = np.uint8)
+    while True:
+        batch = list(itertools.islice(states, batch_size))
+        if len(batch) == 0:
+            return
+        yield encode_states(batch, shape, out)
+
+def iter_shard_batches(shard_files, batch_size = 256, copy = False):
+    """stream (encoded batch, labels, distances) from dataset shards.
+       encoded batches of a shard share one buffer, which is overwritten
+       by the next batch, unless copy is true (e.g. to keep batches)
+    """
+    for shard_file in shard_files:
+        with np.load(shard_file) as shard:
+            grids, shapes = shard["grids"], shard["shapes"]
+            labels, distances = shard["labels"], shard["distances"]
+        out = None if copy else \
+              np.empty((batch_size, len(CHANNELS)) + grids.shape[1 :],
+                       dtype = np.uint8)
+        for k in range(0, len(grids), batch_size):
+            yield encode_grids(grids[k : k + batch_size],
+                               shapes[k : k + batch_size], out), \
+                  labels[k : k + batch_size], distances[k : k + batch_size]
@@ -1,9 +1,50 @@
 # utility functions
 
+import sys
 import time
+import importlib
+import numpy as np
+from collections import OrderedDict
 
 from constants import *
 
+class LazyModule:
+    """stand-in for a module that is only imported on first attribute
+       access, so that heavy dependencies don't slow down startup
+    """
+    def __init__(self, name):
+        self.__dict__["_name"] = name
+        self.__dict__["_module"] = None
+
+    def _load(self):
+        if self._module is None:
+            self.__dict__["_module"] = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded"
+        return "<lazy module '%s' (%s)>" % (self._name, state)
+
+def lazy_import(name):
+    """module proxy for name, or the module itself if already imported"""
+    module = sys.modules.get(name)
+    return module if module is not None else LazyModule(name)
+
+def preload(module):
+    """import a lazily imported module now, e.g. in a worker process that
+       should be warm before its first job
+    """
+    return module._load() if isinstance(module, LazyModule) else module
+
 def manhattan_dist(x, y):
     """calculate L1 distance between two iterables or Positions"""
     return sum([abs(a - b) for a, b in zip(x, y)])
@@ -59,32 +100,176 @@ def print_timings(parent = None, indent = ""):
             print(indent + name + ": " + str(total))
             print_timings(name, indent + " ")
 
+def subboard_offsets(area, shape, position = None):
+    """column, row offsets of every subboard of size (area) on a board,
+       restricted to subboards that contain position if it is given
+    """
+    dx_range = range(shape[1] - area[1] + 1)
+    dy_range = range(shape[0] - area[0] + 1)
+    if position is not None:
+        dx_range = range(max(0, position[1] - area[1] + 1),
+                         min(position[1], shape[1] - area[1]) + 1)
+        dy_range = range(max(0, position[0] - area[0] + 1),
+                         min(position[0], shape[0] - area[0]) + 1)
+    for dx in dx_range:
+        for dy in dy_range:
+            yield dx, dy
+
 @record_time
-def deadlock_detected(deadlock_table, sokoban, deadlock_type = None):
+def deadlock_detected(deadlock_table, sokoban, deadlock_type = None,
+                      position = None):
     """match every subboard against the deadlock lookup table
        input: deadlock_table: mapping from { area : set(board, ...) }
               sokoban: Sokoban object
               deadlock_type: "static" | "dynamic" | None
+              position: if given, only check subboards containing position
        output: boolean
     """
     for area in deadlock_table:
         # check if any pattern in list matches part of board
         # iterate over subboards of size (area) and lookup pattern in table
-        for dx in range(sokoban.board.cols - area[1] + 1):
-            for dy in range(sokoban.board.rows - area[0] + 1):
-                if deadlock_type == "dynamic":
-                    bounds = (dy, dy + area[0], dx, dx + area[1])
-                    # skip if a goal is contained within the subboard
-                    if any([goal.in_bounds(*bounds) for goal in sokoban.goals]):
-                        continue
-                elif deadlock_type == "static":
-                    # skip if a box is on top of a goal
-                    if any([sokoban.board[goal] == BOX
-                            for goal in sokoban.goals]):
-                        continue
-
-                # look up the subboard in the deadlock table
-                subboard = sokoban.board[dy : dy + area[0], dx : dx + area[1]]
-                if subboard in deadlock_table[area]:
-                    return True
+        for dx, dy in subboard_offsets(area, sokoban.board.shape, position):
+            if deadlock_type == "dynamic":
+                bounds = (dy, dy + area[0], dx, dx + area[1])
+                # skip if a goal is contained within the subboard
+                if any([goal.in_bounds(*bounds) for goal in sokoban.goals]):
+                    continue
+            elif deadlock_type == "static":
+                # skip if a box is on top of a goal
+                if any([sokoban.board[goal] == BOX
+                        for goal in sokoban.goals]):
+                    continue
+
+            # look up the subboard in the deadlock table
+            subboard = sokoban.board[dy : dy + area[0], dx : dx + area[1]]
+            if subboard in deadlock_table[area]:
+                return True
     return False
+
+# base-3 digit of each object in encoded boards, see Board.encode
+encoding_digits = np.zeros(256, dtype = np.int64)
+encoding_digits[WALL] = 1
+encoding_digits[BOX] = 2
+
+def encode_boards(boards):
+    """vectorized Board.encode over the last two axes of an array"""
+    area = boards.shape[-2 :]
+    powers = 3 ** np.arange(area[0] * area[1], dtype = np.int64)
+    digits = encoding_digits[boards.reshape(boards.shape[: -2] + (-1,))]
+    return digits @ powers
+
+def table_codes(deadlock_table, area):
+    """sorted array of codes of all boards of size (area) in the table"""
+    boards = deadlock_table[area]
+    codes = getattr(boards, "codes", None)
+    if codes is None:
+        # boards of other shapes can never match a subboard of size (area)
+        boards = [board for board in boards if board.shape == tuple(area)]
+        if len(boards) == 0:
+            return np.zeros(0, dtype = np.int64)
+        codes = np.unique(encode_boards(np.stack(boards)))
+    return codes
+
+@record_time
+def deadlock_detected_many(deadlock_table, boards, goals = None,
+                           deadlock_type = None, codes = None):
+    """match every subboard of a batch of boards against the table
+       input: deadlock_table: mapping from { area : set(board, ...) }
+              boards: (N, rows, cols) array of boards of the same puzzle
+              goals: (rows, cols) boolean array of goal positions
+              deadlock_type: "static" | "dynamic" | None
+              codes: optional mapping from { area : table_codes(...) }
+       output: (N,) boolean array
+    """
+    detected = np.zeros(len(boards), dtype = bool)
+    if goals is None:
+        goals = np.zeros(boards.shape[1 :], dtype = bool)
+
+    checked = np.ones(len(boards), dtype = bool)
+    if deadlock_type == "static":
+        # skip if a box is on top of a goal
+        checked = ~((boards == BOX) & goals).any(axis = (1, 2))
+
+    for area in deadlock_table:
+        if area[0] > boards.shape[1] or area[1] > boards.shape[2]:
+            continue
+        codes_ = table_codes(deadlock_table, area) \
+                 if codes is None or area not in codes else codes[area]
+
+        # look up the code of every subboard in the sorted table codes
+        windows = np.lib.stride_tricks.sliding_window_view(
+            boards, area, axis = (1, 2))
+        window_codes = encode_boards(windows)
+        index = np.minimum(np.searchsorted(codes_, window_codes),
+                           max(len(codes_) - 1, 0))
+        found = (codes_[index] == window_codes) if len(codes_) > 0 else \
+                np.zeros(window_codes.shape, dtype = bool)
+
+        if deadlock_type == "dynamic":
+            # skip if a goal is contained within the subboard
+            goal_windows = np.lib.stride_tricks.sliding_window_view(
+                goals, area).any(axis = (2, 3))
+            found &= ~goal_windows[None]
+        detected |= found.any(axis = (1, 2))
+    return detected & checked
+
+class LRUCache:
+    """bounded mapping that evicts least recently used entries first,
+       limited by number of entries and / or approximate size in bytes
+    """
+    def __init__(self, max_entries = 10 ** 5, max_bytes = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default = None):
+        entry = self.entries.get(key, _missing)
+        if entry is _missing:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, value):
+        if key in self.entries:
+            self.bytes -= self.entries.pop(key)[1]
+        size = approx_size(key) + approx_size(value)
+        self.entries[key] = (value, size)
+        self.bytes += size
+
+        # evict from the least recently used end until within limits
+        while len(self.entries) > 0 and \
+              ((self.max_entries is not None and
+                len(self.entries) > self.max_entries) or
+               (self.max_bytes is not None and self.bytes > self.max_bytes)):
+            _, (_, size) = self.entries.popitem(last = False)
+            self.bytes -= size
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def info(self):
+        return { "hits" : self.hits, "misses" : self.misses,
+                 "entries" : len(self.entries), "bytes" : self.bytes }
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+_missing = object()
+
+def approx_size(obj):
+    """shallow size of object in bytes, including items of tuples"""
+    size = sys.getsizeof(obj)
+    if type(obj) is tuple:
+        size += sum(map(approx_size, obj))
+    return size
@@ -0,0 +1,117 @@
+# background worker for the curses game (puzzle prefetching + solving)
+
+import os
+import queue
+import multiprocessing
+
+from random import *
+
+from constants import *
+from generator import *
+from sokoban import *
+from solver import *
+
+# functions
+
+def default_solver():
+    return AStarSolver(ManhattanDistHeuristic())
+
+def generate_puzzles(puzzles, generator_options, puzzle_options):
+    """keep the queue of puzzles full, runs in its own process"""
+    seed(os.urandom(8))
+    np.random.seed(int.from_bytes(os.urandom(4), "little"))
+    gen = I2AGenerator(**generator_options)
+    while True:
+        sokoban = gen.generate(**puzzle_options)
+        if sokoban is not None:
+            puzzles.put(sokoban)
+
+def solve_puzzle(conn, sokoban, solver_factory, max_nodes):
+    """solve sokoban + send back the list of pushes (or None)"""
+    solution = solver_factory().solve(sokoban, max_nodes = max_nodes)
+    conn.send(None if solution is None else solution[1 :: 2])
+    conn.close()
+
+# classes
+
+class GameWorker:
+    """runs puzzle generation + solving in background processes, so that
+       the game loop only ever polls for results and never blocks on them
+    """
+    def __init__(self, prefetch = 3, generator_options = None,
+                 puzzle_options = None, solver_factory = default_solver,
+                 max_nodes = 10 ** 5):
+        self.solver_factory = solver_factory
+        self.max_nodes = max_nodes
+
+        # generated puzzles are queued until the player asks for one
+        self.puzzles = multiprocessing.Queue(maxsize = prefetch)
+        self.generator = multiprocessing.Process(
+            target = generate_puzzles, daemon = True,
+            args = (self.puzzles, generator_options or {},
+                    puzzle_options or {}))
+        self.generator.start()
+
+        self.solver = None
+        self.conn = None
+
+    def next_puzzle(self):
+        """prefetched puzzle, or None if none is ready yet"""
+        try:
+            return self.puzzles.get_nowait()
+        except queue.Empty:
+            return None
+
+    def solve(self, sokoban):
+        """start solving sokoban, cancelling any solve in progress"""
+        self.cancel()
+        self.conn, conn = multiprocessing.Pipe(duplex = False)
+        self.solver = multiprocessing.Process(
+            target = solve_puzzle, daemon = True,
+            args = (conn, sokoban.copy(), self.solver_factory,
+                    self.max_nodes))
+        self.solver.start()
+        conn.close()
+
+    @property
+    def solving(self):
+        return self.solver is not None
+
+    def poll_solution(self):
+        """output: (True, pushes or None if unsolvable) once the solve has
+           finished, or (False, None) while it is still running
+        """
+        if self.solver is None:
+            return False, None
+        try:
+            if not self.conn.poll():
+                return False, None
+            solution = self.conn.recv()
+        except EOFError:
+            # solver process died w/o sending a result
+            solution = None
+        self.cancel()
+        return True, solution
+
+    def cancel(self):
+        if self.solver is None:
+            return
+        if self.solver.is_alive():
+            self.solver.terminate()
+        self.solver.join()
+        self.conn.close()
+        self.solver = None
+        self.conn = None
+
+    def close(self):
+        self.cancel()
+        self.generator.terminate()
+        self.generator.join()
+        self.puzzles.cancel_join_thread()
+        self.puzzles.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()